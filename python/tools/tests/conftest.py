@@ -0,0 +1,64 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# The tests run on the messages of tmf8828_synthetic, no EVM or sensor needed:
+#   python -m pytest python/tools/tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+# the messages as the Tmf8820_msg_view a message source yields
+def views( messages ):
+    return iter([tof.Tmf8820_msg_view(msg) for msg in messages])
+
+# (capture_num, sub_capture) of a histogram or statistics message,
+# (result_num, None) of a results message, None of any other message
+def captureOf( view ):
+    msg_id = view.hdr.id
+    if msg_id == tof.HISTOGRAM_ID_MEASUREMENT:
+        return view.hist_msg.capture_num, view.hist_msg.sub_capture
+    if msg_id == 2:
+        return view.meas_stat_msg.capture_num, view.meas_stat_msg.sub_capture
+    if msg_id == 1:
+        return view.meas_result_msg.result_num, None
+    return None
+
+# the messages without the messages of capture_num capture with an id in ids,
+# only those of sub_capture if it is given
+def withoutCapture( messages, capture, sub_capture=None, ids=(1, 2, tof.HISTOGRAM_ID_MEASUREMENT) ):
+    kept = []
+    for msg in messages:
+        view = tof.Tmf8820_msg_view(msg)
+        key = captureOf(view)
+        if key is not None and view.hdr.id in ids and key[0] == capture and sub_capture in (None, key[1]):
+            continue
+        kept.append(msg)
+    return kept
+
+# the messages with extra inserted before message number index
+def insertAt( messages, index, *extra ):
+    return messages[:index] + list(extra) + messages[index:]
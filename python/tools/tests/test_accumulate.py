@@ -0,0 +1,96 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import ctypes
+
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from tmf8828_accumulate import FrameRingBuffer
+from conftest import views
+
+
+def frames( n ):
+    return list(tof.stream_8x8_frames(views(synthetic.messages8x8(n + 1))))[:n]
+
+def histograms( frames ):
+    return np.stack([frame.histograms for frame in frames]).astype(np.int64)
+
+
+def test_running_statistics_match_the_buffered_frames():
+    recorded = frames(6)
+    ring = FrameRingBuffer(4)
+    for frame in recorded[:3]:
+        ring.append(frame)
+    assert len(ring) == 3 and not ring.full
+    for frame in recorded[3:]:
+        ring.append(frame)
+    assert ring.full and ring.appended == 6
+    last = histograms(recorded[2:])
+    assert ( ring.sum() == last.sum(axis=0) ).all()
+    assert np.allclose(ring.mean(), last.mean(axis=0))
+    assert np.allclose(ring.variance(), last.var(axis=0))
+    assert ( ring.sum(2) == last[2:].sum(axis=0) ).all()
+    assert np.allclose(ring.variance(2), last[2:].var(axis=0))
+    assert ring.window()['capture_num'].tolist() == [frame.capture_num for frame in recorded[2:]]
+
+def test_clear_empties_the_buffer():
+    ring = FrameRingBuffer(2)
+    for frame in frames(3):
+        ring.append(frame)
+    ring.clear()
+    assert len(ring) == 0
+    assert not ring.sum().any()
+    assert len(ring.window()) == 0
+
+def test_measurement_statistics_are_buffered():
+    recorded = frames(3)
+    assert recorded[1].stats['capture_num'].tolist() == recorded[1].hist_info[:, 0].tolist()
+    assert recorded[1].stats['sub_capture'].tolist() == [0, 1] * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE
+    ring = FrameRingBuffer(2)
+    for frame in recorded:
+        ring.append(frame)
+    assert ( ring.statsWindow() == np.stack([frame.stats for frame in recorded[1:]]) ).all()
+    assert ( ring.frames()[-1].stats == recorded[-1].stats ).all()
+
+def test_ticks_range_across_the_counter_wrap():
+    recorded = frames(5)
+    start = 2**32 - 2 * 4700
+    for n, frame in enumerate(recorded):
+        # as received: a signed 32 bit field of the results message
+        frame.sys_ticks = ctypes.c_int(( start + n * 4700 ) & 0xFFFFFFFF).value
+    ring = FrameRingBuffer(8)
+    for frame in recorded:
+        ring.append(frame)
+    window = ring.ticksWindow(start + 4700, start + 3 * 4700)
+    assert ring.records['capture_num'][window].tolist() == [recorded[1].capture_num, recorded[2].capture_num]
+    total, count = ring.sumTicks(start + 4700 - 2**32, start + 3 * 4700)
+    assert count == 2
+    assert ( total == histograms(recorded[1:3]).sum(axis=0) ).all()
+    assert len(ring.ticksWindow(start, start)) == 0
+
+def test_obj_distance_mean():
+    recorded = frames(3)
+    ring = FrameRingBuffer(3)
+    for frame in recorded:
+        ring.append(frame)
+    expected = np.mean([frame.distance_map for frame in recorded], axis=0)
+    assert np.allclose(ring.objDistanceMean(), expected)
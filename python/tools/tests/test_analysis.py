@@ -0,0 +1,112 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import pickle
+import threading
+
+import pytest
+
+import tmf8828_analysis as analysis
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from conftest import views
+
+
+def frames( n ):
+    return list(tof.stream_8x8_frames(views(synthetic.messages8x8(n))))
+
+def analyze( stage, frames ):
+    with stage:
+        for frame in frames:
+            assert stage.submit(frame)
+        stage.finish()
+        return list(stage)
+
+
+def test_kernel_results_in_frame_order():
+    captured = frames(4)
+    results = analyze(analysis.AnalysisStage('crosstalk'), captured)
+    assert [frame.capture_num for frame, _ in results] == [0, 4, 8, 12]
+    for frame, values in results:
+        assert ( values == analysis.crosstalk(frame.channels) ).all()
+
+def test_legacy_function_uses_its_kernel():
+    stage = analysis.AnalysisStage(tof.calc_crosstalk)
+    assert stage.function is analysis.crosstalk and stage.vectorized
+    frame, values = analyze(stage, frames(1))[0]
+    assert values.tolist() == [tof.calc_crosstalk(h) for h in frame.channels.tolist()]
+
+def test_process_pool_results_in_frame_order():
+    captured = frames(5)
+    results = analyze(analysis.AnalysisStage(sum, processes=2), captured)
+    assert [frame.capture_num for frame, _ in results] == [0, 4, 8, 12, 16]
+    for frame, values in results:
+        assert values == frame.channels.sum(axis=1).tolist()
+
+def test_process_pool_rejects_unpicklable_functions():
+    with pytest.raises((pickle.PicklingError, AttributeError)):
+        analysis.AnalysisStage(lambda h: max(h))
+
+def test_error_of_the_analysis_ends_the_stage():
+    def fail_on_second( channels, seen=[] ):
+        seen.append(channels)
+        if len(seen) == 2:
+            raise ValueError("bad frame")
+        return channels.max(axis=1)
+    stage = analysis.AnalysisStage(fail_on_second, vectorized=True)
+    with stage:
+        for frame in frames(3):
+            stage.submit(frame)
+        assert stage.get(timeout=5)[0].capture_num == 0
+        with pytest.raises(ValueError):
+            stage.get(timeout=5)
+
+def test_full_queue_drops_frames():
+    entered, release = threading.Event(), threading.Event()
+    def blocking( channels ):
+        entered.set()
+        release.wait(5)
+        return channels.max(axis=1)
+    captured = frames(5)
+    stats = tof.CaptureStats()
+    with analysis.AnalysisStage(blocking, vectorized=True, queue_size=1, stats=stats) as stage:
+        assert stage.submit(captured[0])
+        assert entered.wait(5)
+        # the worker is busy with the first frame: one fits into the queue
+        assert [stage.submit(frame) for frame in captured[1:]] == [True, False, False, False]
+        release.set()
+        stage.finish()
+        assert [frame.capture_num for frame, _ in stage] == [0, 4]
+    assert stage.dropped == 3 and stage.processed == 2
+    assert stats.stage_count['callback'] == 2
+    assert stats.queue_depth['analysis'][1] == 1
+
+def test_close_stops_the_receiver():
+    with synthetic.SyntheticPublisher() as pub:
+        sub = tof.connectToRaspi(pub.uri)
+        stage = analysis.AnalysisStage('peak')
+        receiver = stage.receive(sub)
+        frame, values = stage.get(timeout=10)
+        assert values.shape == (tof.HISTOGRAMS_IN_8X8_MODE,)
+    # no more messages arrive, the receiver waits for them
+    stage.close()
+    assert not receiver.is_alive()
+    assert not stage.worker.is_alive()
+    sub.close(linger=0)
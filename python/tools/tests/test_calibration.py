@@ -0,0 +1,85 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import os
+
+import numpy as np
+
+import tmf8828_calibration as calibration
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from tmf8828_analysis import AMBIENT_BINS, CROSSTALK_BINS
+from conftest import views
+
+
+def frames( n, scene=None ):
+    return list(tof.stream_8x8_frames(views(synthetic.messages8x8(n, scene=scene))))
+
+
+def test_crosstalk_peak_like_calc_crosstalk():
+    frame = frames(1)[0]
+    calib = calibration.calibrate([frame])
+    expected = [tof.calc_crosstalk(h) for h in frame.histograms.reshape(64, -1).tolist()]
+    assert calib.crosstalk_peak.ravel().tolist() == expected
+    assert calib.frames == 1
+
+def test_cache_round_trip( tmp_path ):
+    calib = calibration.getCalibration(views(synthetic.messages8x8(4)), "dev-1", str(tmp_path), frames=3)
+    assert calib.frames == 3 and calib.uid == "dev-1"
+    assert os.path.exists(calibration.cachePath("dev-1", str(tmp_path)))
+    # cached: the stream is not read
+    cached = calibration.getCalibration(views([]), "dev-1", str(tmp_path))
+    assert cached.uid == "dev-1" and cached.frames == 3
+    for table in ("crosstalk", "crosstalk_peak", "zero_bins"):
+        assert ( getattr(cached, table) == getattr(calib, table) ).all()
+
+def test_cache_of_another_uid_is_not_used( tmp_path ):
+    calibration.getCalibration(views(synthetic.messages8x8(1)), "a/b", str(tmp_path), frames=1)
+    assert calibration.cachePath("a/b", str(tmp_path)) == calibration.cachePath("a_b", str(tmp_path))
+    assert calibration.getCalibration(views([]), "a_b", str(tmp_path)) is None
+    calib = calibration.getCalibration(views(synthetic.messages8x8(1)), "a_b", str(tmp_path), frames=1)
+    assert calib.uid == "a_b"
+    assert calibration.getCalibration(views([]), "a_b", str(tmp_path)).uid == "a_b"
+
+def test_cache_of_another_version_is_not_used( tmp_path, monkeypatch ):
+    calibration.getCalibration(views(synthetic.messages8x8(1)), "dev-1", str(tmp_path), frames=1)
+    monkeypatch.setattr(calibration, "CALIBRATION_VERSION", calibration.CALIBRATION_VERSION + 1)
+    assert calibration.Calibration.load(calibration.cachePath("dev-1", str(tmp_path))) is None
+
+def test_apply_removes_ambient_and_crosstalk():
+    frame = frames(1)[0]
+    calib = calibration.calibrate([frame])
+    out = np.empty(calib.crosstalk.shape, dtype=np.float32)
+    histograms = calib.apply(frame, out)
+    assert histograms is out
+    expected = frame.histograms - frame.histograms[..., AMBIENT_BINS].mean(axis=-1, keepdims=True)
+    outside = np.ones(tof.BINS_PER_TDC_CHANNEL, dtype=bool)
+    outside[CROSSTALK_BINS] = False
+    assert np.allclose(histograms[..., outside], expected[..., outside], atol=1e-3)
+    # the crosstalk of the frame itself is removed entirely
+    assert ( histograms[..., CROSSTALK_BINS] <= 1e-3 ).all()
+
+def test_depth_with_calibration():
+    calib = calibration.calibrate(frames(4, synthetic.SyntheticScene(1)))
+    scene = synthetic.SyntheticScene(3)
+    distance_mm, confidence = calib.depth(frames(1, scene)[0])
+    expected = scene.distance_mm[tof.PIXEL_HISTOGRAM_NUMBERS].reshape(8, 8)
+    assert ( abs(distance_mm - expected) < calibration.MM_PER_BIN / 2 ).all()
+    assert ( confidence > 0 ).all()
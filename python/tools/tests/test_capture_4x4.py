@@ -0,0 +1,93 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import pytest
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from conftest import insertAt, views, withoutCapture
+
+MESSAGES_PER_CAPTURE = 5       # 2 histogram, 2 statistics and 1 results message in 4x4 mode
+
+
+def stream( messages, **options ):
+    session = tof.Capture4x4Session(**options)
+    frames = list(tof.stream_4x4_frames(views(messages), session))
+    return frames, session
+
+
+def test_clean_4x4_stream():
+    frames, session = stream(synthetic.messages4x4(5))
+    assert [frame.capture_num for frame in frames] == [0, 1, 2, 3, 4]
+    assert all(frame.sub_captures == 2 and frame.obj_shape == (4, 4) for frame in frames)
+    assert session.frames_dropped == session.captures_missed == session.resyncs == 0
+
+def test_3x3_stream():
+    frames, session = stream(synthetic.messages4x4(5, sub_captures=1))
+    assert [frame.capture_num for frame in frames] == [0, 1, 2, 3, 4]
+    assert all(frame.sub_captures == 1 and frame.obj_shape == (3, 3) for frame in frames)
+
+def test_statistics_attached():
+    frames, _ = stream(synthetic.messages4x4(3))
+    assert frames[1].stats['capture_num'].tolist() == [1, 1]
+    assert frames[1].stats['sub_capture'].tolist() == [0, 1]
+
+def test_capture_num_wraps_at_256():
+    frames, session = stream(synthetic.messages4x4(4, start=254, calibration=False))
+    assert [frame.capture_num for frame in frames] == [254, 255, 0, 1]
+    assert session.captures_missed == session.out_of_order == 0
+
+def test_missing_sub_capture_drops_the_measurement():
+    messages = withoutCapture(list(synthetic.messages4x4(5, calibration=False)), 2, sub_capture=1, ids=(tof.HISTOGRAM_ID_MEASUREMENT,))
+    frames, session = stream(messages)
+    assert [frame.capture_num for frame in frames] == [0, 1, 3, 4]
+    assert all(frame.obj_shape == (4, 4) for frame in frames)
+    assert session.frames_dropped == 1
+
+def test_missing_capture_keeps_the_complete_frame():
+    frames, session = stream(withoutCapture(list(synthetic.messages4x4(4, calibration=False)), 1))
+    assert [frame.capture_num for frame in frames] == [0, 2, 3]
+    assert session.captures_missed == 1
+    assert session.frames_dropped == 1
+
+def test_device_error_is_recovered():
+    messages = insertAt(list(synthetic.messages4x4(4, calibration=False)), MESSAGES_PER_CAPTURE + 2, synthetic.errorMessage(3))
+    frames, session = stream(messages)
+    assert [frame.capture_num for frame in frames] == [0, 2, 3]
+    assert session.device_errors == 1
+    assert session.frames_dropped == 1
+    assert session.error is None
+
+def test_device_error_without_recover():
+    messages = insertAt(list(synthetic.messages4x4(4, calibration=False)), MESSAGES_PER_CAPTURE + 2, synthetic.errorMessage(3))
+    frames, session = stream(messages, recover=False)
+    assert [frame.capture_num for frame in frames] == [0]
+    assert isinstance(session.exception, tof.DeviceError)
+
+def test_capture_returns_typed_result():
+    result = tof.captureHistograms4x4(synthetic.SyntheticSocket(synthetic.messages4x4(4)), [1, 2, 12])
+    assert isinstance(result, tof.Capture4x4Result)
+    assert result.zones.shape == (3, tof.BINS_PER_TDC_CHANNEL)
+    assert ( result.zones[0] == result.frame.channels[1] ).all()
+
+def test_capture_raises_at_end_of_stream():
+    with pytest.raises(tof.EndOfStreamError):
+        # only the electrical calibration histograms
+        tof.captureHistograms4x4(views(list(synthetic.messages4x4(1))[:2]))
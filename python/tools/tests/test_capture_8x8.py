@@ -0,0 +1,274 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import itertools
+import pytest
+import zmq
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from conftest import insertAt, views, withoutCapture
+
+MESSAGES_PER_CAPTURE = 5       # 2 histogram, 2 statistics and 1 results message
+
+
+def stream( messages, **options ):
+    session = tof.Capture8x8Session(**options)
+    frames = [frame.capture_num for frame in tof.stream_8x8_frames(views(messages), session)]
+    return frames, session
+
+
+def test_clean_stream():
+    frames, session = stream(synthetic.messages8x8(6))
+    assert frames == [0, 4, 8, 12, 16, 20]
+    assert session.frames == 6
+    assert session.frames_dropped == session.captures_missed == session.out_of_order == session.resyncs == 0
+    assert session.error is None
+
+def test_frame_content():
+    scene = synthetic.SyntheticScene(3)
+    frame = next(tof.stream_8x8_frames(views(synthetic.messages8x8(2, scene=scene))))
+    assert frame.hist_info[:, 0].tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert ( frame.histograms.reshape(64, -1) == frame.channels[tof.PIXEL_HISTOGRAM_NUMBERS] ).all()
+    # every pixel has its target in the results
+    assert ( frame.confidence_map[..., 0] > 0 ).all()
+    assert abs(frame.distance_map[0, 0, 0] - scene.distance_mm[tof.PIXEL_HISTOGRAM_NUMBERS[0]]) < 1
+
+def test_capture_num_wraps_at_256():
+    frames, session = stream(synthetic.messages8x8(4, start=248))
+    assert frames == [248, 252, 0, 4]
+    assert session.frames_dropped == session.captures_missed == session.out_of_order == 0
+
+def test_endless_synthetic_socket():
+    session = tof.Capture8x8Session()
+    frames = [frame.capture_num for frame in itertools.islice(tof.stream_8x8_frames(synthetic.SyntheticSocket(synthetic.messages8x8(4)), session), 100)]
+    assert frames == [( 4 * n ) % 256 for n in range(100)]
+    assert session.frames_dropped == session.captures_missed == session.out_of_order == 0
+
+def test_missing_capture_keeps_the_complete_frame():
+    frames, session = stream(withoutCapture(list(synthetic.messages8x8(4)), 4))
+    assert frames == [0, 8, 12]
+    assert session.captures_missed == 1
+    assert session.frames_dropped == 1          # the sequence of captures 4 to 7
+    assert session.resyncs == 1
+
+def test_missing_sub_capture_drops_the_frame():
+    frames, session = stream(withoutCapture(list(synthetic.messages8x8(4)), 6, sub_capture=1, ids=(tof.HISTOGRAM_ID_MEASUREMENT,)))
+    assert frames == [0, 8, 12]
+    assert session.frames_dropped == 1
+    assert session.captures_missed == 0
+
+def test_counter_restart_is_not_counted_as_dropped_frames():
+    messages = list(synthetic.messages8x8(3, start=100)) + list(synthetic.messages8x8(3))
+    frames, session = stream(messages)
+    assert frames == [100, 104, 108, 0, 4, 8]
+    assert session.out_of_order == 1
+    assert session.frames_dropped == 0
+
+def test_device_error_is_recovered():
+    messages = insertAt(list(synthetic.messages8x8(4)), 5 * MESSAGES_PER_CAPTURE + 2, synthetic.errorMessage(7))
+    frames, session = stream(messages)
+    assert frames == [0, 8, 12]
+    assert session.device_errors == 1
+    assert session.resyncs == 1
+    assert session.frames_dropped == 1
+    assert session.error is None
+
+def test_device_error_without_recover():
+    messages = insertAt(list(synthetic.messages8x8(4)), 5 * MESSAGES_PER_CAPTURE + 2, synthetic.errorMessage(7))
+    frames, session = stream(messages, recover=False)
+    assert frames == [0]
+    assert isinstance(session.exception, tof.DeviceError)
+    assert session.exception.error_code == 7
+    assert session.error == "#ERROR;CODE: 7\n"
+
+def test_stall_is_recovered():
+    flood = [synthetic.resultsMessage(0, [])] * ( tof.MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES + 10 )
+    frames, session = stream(insertAt(list(synthetic.messages8x8(4)), 5 * MESSAGES_PER_CAPTURE + 2, *flood))
+    assert frames == [0, 8, 12]
+    assert session.stalls == 1
+    assert session.error is None
+
+def test_gives_up_without_histograms():
+    flood = [synthetic.resultsMessage(0, [])] * ( 4 * ( tof.MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES + 1 ) )
+    frames, session = stream(list(synthetic.messages8x8(1)) + flood, max_recoveries=3)
+    assert frames == [0]
+    assert session.stalls == 3
+    assert isinstance(session.exception, tof.HistogramDumpingError)
+
+def test_stream_recovers_without_limit_by_default():
+    stalls = tof.MAX_RECOVERIES_WITHOUT_FRAME + 2
+    flood = [synthetic.resultsMessage(0, [])] * ( stalls * ( tof.MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES + 1 ) )
+    frames, session = stream(list(synthetic.messages8x8(1)) + flood + list(synthetic.messages8x8(1, start=4)))
+    assert frames == [0, 4]
+    assert session.stalls == stalls
+    assert session.error is None
+
+def test_capture_gives_up_by_default():
+    flood = [synthetic.resultsMessage(0, [])] * ( ( tof.MAX_RECOVERIES_WITHOUT_FRAME + 1 ) * ( tof.MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES + 1 ) )
+    session = tof.Capture8x8Session()
+    assert session.capture(views(flood)) is None
+    assert session.stalls == tof.MAX_RECOVERIES_WITHOUT_FRAME
+    assert isinstance(session.exception, tof.HistogramDumpingError)
+
+def test_time_multiplexing_not_enabled():
+    messages = list(synthetic.messages8x8(3))
+    for capture in range(12):
+        messages = withoutCapture(messages, capture, sub_capture=1)
+    frames, session = stream(messages)
+    assert frames == []
+    assert isinstance(session.exception, tof.TimeMultiplexingError)
+
+def test_reuse_frames_alternates_two_frames():
+    session = tof.Capture8x8Session(reuse_frames=True)
+    frames = list(itertools.islice(tof.stream_8x8_frames(synthetic.SyntheticSocket(synthetic.messages8x8(4)), session), 6))
+    assert len({id(frame) for frame in frames}) == 2
+
+def test_capture_returns_typed_result():
+    result = tof.captureHistograms8x8(synthetic.SyntheticSocket(synthetic.messages8x8(4)), tof.calc_crosstalk)
+    assert isinstance(result, tof.Capture8x8Result)
+    assert result.log.count("#HISTINFO") == 8
+    assert sorted(result.values) == list(range(tof.HISTOGRAMS_IN_8X8_MODE))
+    assert result.frame.capture_num == 0
+
+def test_capture_raises_at_end_of_stream():
+    with pytest.raises(tof.EndOfStreamError):
+        # the histograms of capture 3, sub-capture 1 are missing
+        tof.captureHistograms8x8(views(list(synthetic.messages8x8(1))[:-3]))
+
+def test_frame_is_complete_with_the_results_of_its_last_capture():
+    session = tof.Capture8x8Session()
+    frames = [session.feed(msg) for msg in views(synthetic.messages8x8(1))]
+    assert frames[-1] is not None and frames[-1].capture_num == 0
+    assert frames[:-1] == [None] * ( len(frames) - 1 )
+    assert ( frames[-1].confidence_map[..., 0] > 0 ).all()
+
+def test_complete_frame_without_results_is_flushed_at_end_of_stream():
+    frames, session = stream(list(synthetic.messages8x8(2))[:-1])
+    assert frames == [0, 4]
+    assert session.frames_dropped == 0
+
+# zmq socket holding queued messages that recv( zmq.NOBLOCK ) returns without
+# waiting, the later ones only arrive with a blocking recv()
+class QueuedSocket:
+    def __init__(self, queued, later):
+        self.queued = [zmq.Frame(message) for message in queued]
+        self.later = iter([zmq.Frame(message) for message in later])
+
+    def recv(self, flags=0, copy=True):
+        if self.queued:
+            return self.queued.pop(0)
+        if flags & zmq.NOBLOCK:
+            raise zmq.Again()
+        return next(self.later)
+
+def test_capture_drains_queued_messages():
+    stale = list(synthetic.messages8x8(2, start=100))
+    session = tof.Capture8x8Session()
+    frame = session.capture(QueuedSocket(stale, synthetic.messages8x8(1)))
+    assert frame.capture_num == 0
+    assert session.drained == len(stale)
+    assert 0 < session.time_to_first_frame_ns
+
+def test_capture_without_drain_locks_on_to_queued_messages():
+    session = tof.Capture8x8Session()
+    frame = session.capture(QueuedSocket(synthetic.messages8x8(2, start=100), synthetic.messages8x8(1)), drain=False)
+    assert frame.capture_num == 100
+    assert session.drained == 0
+
+def test_capture_locks_on_to_the_first_sequence_start():
+    # starts in the middle of a sequence, the first one that starts is returned
+    messages = list(synthetic.messages8x8(2))[2 * MESSAGES_PER_CAPTURE:]
+    session = tof.Capture8x8Session()
+    assert session.capture(QueuedSocket([], messages)).capture_num == 4
+    assert session.frames_dropped == 0
+
+def test_connect_sets_the_receive_high_water_mark():
+    ctx = zmq.Context()
+    sub = tof.connectToRaspi("inproc://tmf8828_test_rcvhwm", ctx, rcvhwm=10)
+    try:
+        assert sub.getsockopt(zmq.RCVHWM) == 10
+    finally:
+        sub.close(linger=0)
+        ctx.term()
+
+def test_legacy_wrapper_return_types():
+    sub = synthetic.SyntheticSocket(synthetic.messages8x8(4))
+    assert isinstance(tof.getAllHistogramsIn8x8Mode(sub), str)
+    log, values = tof.getAllHistogramsIn8x8Mode(sub, tof.calc_crosstalk)
+    assert isinstance(log, str) and len(values) == tof.HISTOGRAMS_IN_8X8_MODE
+    assert tof.getAllHistogramsIn8x8Mode(views([])) == "#ERROR;End of message stream. Exiting."
+
+def test_histogram_frame_raises_on_errors():
+    histograms, ref_histograms = tof.getHistogramFrameIn8x8Mode(views(synthetic.messages8x8(1)))
+    assert histograms.shape == (8, 8, tof.BINS_PER_TDC_CHANNEL) and ref_histograms.any()
+    with pytest.raises(tof.EndOfStreamError):
+        tof.getHistogramFrameIn8x8Mode(views([]))
+
+@pytest.mark.parametrize("blocking", [True, False])
+def test_device_reader_reads_a_message_file( tmp_path, blocking ):
+    path = tmp_path / "messages.bin"
+    path.write_bytes(b"".join(bytes(message) for message in synthetic.messages8x8(3)))
+    with tof.TofDeviceReader(str(path), read_size=3 * tof.MAX_MSG_SIZE, blocking=blocking) as reader:
+        frames = [frame.capture_num for frame in tof.stream_8x8_frames(reader)]
+    assert frames == [0, 4, 8]
+
+def test_device_reader_keeps_its_buffer_between_captures( tmp_path ):
+    path = tmp_path / "messages.bin"
+    path.write_bytes(b"".join(bytes(message) for message in synthetic.messages8x8(2)))
+    with tof.TofDeviceReader(str(path), read_size=3 * tof.MAX_MSG_SIZE) as reader:
+        first = tof.getAllHistogramsIn8x8Mode(reader)
+        second = tof.getAllHistogramsIn8x8Mode(reader)
+    assert first.count("#HISTINFO") == second.count("#HISTINFO") == 8
+    assert "#ERROR" not in first + second
+
+def test_device_reader_reports_invalid_messages( tmp_path ):
+    path = tmp_path / "messages.bin"
+    messages = list(synthetic.messages8x8(2))
+    path.write_bytes(b"".join(bytes(message) for message in messages[:25]) + bytes(8))
+    session = tof.Capture8x8Session()
+    with tof.TofDeviceReader(str(path)) as reader:
+        assert session.capture(reader) is not None
+        assert session.capture(reader) is None
+    assert isinstance(session.exception, tof.ReadError)
+    assert session.error == reader.error == "#ERROR;Invalid message length 0. Exiting."
+
+def test_module_level_obj_entries():
+    tof.clear_obj_entries()
+    tof.set_obj_entry(1, 0, 3, 1, 1234, 56)
+    obji = ( tof.calc_obj_pix(1, 0, 3) - 1 ) * 2 + 1
+    entry = tof.logfile_obj_accum[obji]
+    assert ( entry.distance_mm, entry.confidence, entry.channel, entry.ch_target_idx ) == ( 1234, 56, 3, 1 )
+    tof.clear_obj_entries()
+    assert not tof.logfile_obj_accum.distance_mm.any()
+    session = tof.Capture8x8Session()
+    tof.getAllHistogramsIn8x8Mode(views(synthetic.messages8x8(2)), session=session)
+    assert tof.logfile_obj_accum.distance_mm.any()
+
+def test_deprecated_fudge_res_num_still_takes_effect( monkeypatch ):
+    results = next(views([synthetic.resultsMessage(1, [(60, 1000, 3, 0, 1), (50, 2000, 5, 1, 0)])])).meas_results
+    expected = tof.newObjEntries()
+    tof.setObjEntries(expected, 1, results, res_num_offset=1)
+    zone = tof.calc_zn(1, 1, 3, res_num_offset=1)
+    monkeypatch.setattr(tof, "fudge_res_num", 1)
+    obj = tof.newObjEntries()
+    tof.setObjEntries(obj, 1, results)
+    assert ( obj == expected ).all()
+    assert tof.calc_zn(1, 1, 3) == zone
@@ -0,0 +1,68 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import numpy as np
+
+import tmf8828_depth as depth
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from conftest import views
+
+BINS = np.arange(tof.BINS_PER_TDC_CHANNEL)
+
+
+def gaussian( center, height, sigma=1.5 ):
+    return height * np.exp(-0.5 * ( ( BINS - center ) / sigma ) ** 2)
+
+
+def test_estimate_depth_of_a_known_peak():
+    centers = np.array([30.0, 40.3, 61.7, 95.5])
+    histograms = 100 + np.stack([gaussian(center, 1000) for center in centers])
+    distance_mm, confidence, peak = depth.estimateDepth(histograms, 14.0)
+    assert np.allclose(peak, centers, atol=0.05)
+    assert np.allclose(distance_mm, ( centers - 14.0 ) * depth.MM_PER_BIN, atol=2)
+    # highest bin over the shot noise of the ambient light, sqrt(100)
+    assert ( ( confidence > 90 ) & ( confidence <= 1000 / 10 ) ).all()
+
+def test_estimate_depth_without_a_peak():
+    distance_mm, confidence, _ = depth.estimateDepth(np.full((2, tof.BINS_PER_TDC_CHANNEL), 100.0), np.array([14.0, 15.0]))
+    assert ( distance_mm == 0 ).all() and ( confidence == 0 ).all()
+
+def test_estimate_depth_subtracts_the_crosstalk():
+    crosstalk = gaussian(14, 2000, sigma=1)
+    # a near target hidden by the crosstalk window without the crosstalk histogram
+    histograms = 100 + crosstalk + gaussian(18, 500)
+    distance_mm, _, peak = depth.estimateDepth(histograms, 14.0, crosstalk=crosstalk)
+    assert abs(peak - 18) < 0.05
+    assert abs(distance_mm - 4 * depth.MM_PER_BIN) < 2
+
+def test_reference_zero_bins():
+    refs = 100 + np.stack([gaussian(14, 2000, sigma=1), gaussian(15.25, 2000, sigma=1)])
+    assert np.allclose(depth.referenceZeroBins(refs), [14, 15.25], atol=0.1)
+
+def test_depth_map_of_a_synthetic_scene():
+    scene = synthetic.SyntheticScene(3)
+    frame = next(tof.stream_8x8_frames(views(synthetic.messages8x8(1, scene=scene))))
+    distance_mm, confidence = depth.depthMap(frame)
+    expected = scene.distance_mm[tof.PIXEL_HISTOGRAM_NUMBERS].reshape(8, 8)
+    assert ( abs(distance_mm - expected) < depth.MM_PER_BIN / 2 ).all()
+    assert ( confidence >= depth.MIN_CONFIDENCE ).all()
+    # the synthetic #OBJ results hold the same distances
+    assert np.nanmax(abs(depth.compareWithObj(distance_mm, confidence, frame))) < depth.MM_PER_BIN / 2
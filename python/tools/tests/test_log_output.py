@@ -0,0 +1,57 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# The reference logs in data/ were written by the first version of
+# getAllHistogramsIn8x8Mode / getAllHistogramsIn4x4Mode from the same synthetic
+# messages. That version skipped the first 10 (8x8) / 40 (4x4) histogram messages
+# to flush the input, the messages here start at the sequence it logged.
+
+import os
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+from conftest import DATA_DIR, views
+
+MESSAGES_PER_CAPTURE = 5
+
+
+def reference( name ):
+    with open(os.path.join(DATA_DIR, name), "r") as file:
+        return file.read()
+
+
+def test_8x8_log_matches_reference():
+    messages = list(synthetic.messages8x8(4, scene=synthetic.SyntheticScene(1)))
+    log = tof.getAllHistogramsIn8x8Mode(views(messages[8 * MESSAGES_PER_CAPTURE:]))
+    assert log == reference("baseline_8x8.txt")
+
+def test_8x8_log_of_reused_frames_matches_reference():
+    messages = list(synthetic.messages8x8(4, scene=synthetic.SyntheticScene(1)))
+    session = tof.Capture8x8Session(reuse_frames=True)
+    log = tof.getAllHistogramsIn8x8Mode(views(messages[8 * MESSAGES_PER_CAPTURE:]), session=session)
+    assert log == reference("baseline_8x8.txt")
+
+def test_4x4_log_matches_reference():
+    messages = list(synthetic.messages4x4(25, scene=synthetic.SyntheticScene(2), calibration=False))
+    log = tof.getAllHistogramsIn4x4Mode(views(messages[20 * MESSAGES_PER_CAPTURE:]))
+    # the #OBJ line of the measurement was added later
+    lines = log.splitlines(keepends=True)
+    assert lines[-1].startswith("#OBJ;")
+    assert "".join(lines[:-1]) == reference("baseline_4x4.txt")
@@ -0,0 +1,157 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import io
+
+import numpy as np
+import pytest
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_logconvert as logconvert
+import tmf8828_synthetic as synthetic
+from tmf8828_recording import FRAME_RECORD_DTYPE, RECORDING_HEADER, RECORDING_HEADER_SIZE, RECORDING_MAGIC, RECORDING_VERSION, \
+                               RecordingReader, RecordingWriter
+from conftest import views
+
+
+def frames( n ):
+    return list(tof.stream_8x8_frames(views(synthetic.messages8x8(n))))
+
+def logText( frames ):
+    log = tof.HistogramLogWriter(io.StringIO(), tof.HIST_LABELS_8X8)
+    for frame in frames:
+        log.writeFrame(frame)
+    return log.file.getvalue()
+
+def assertSameFrame( a, b ):
+    assert a.capture_num == b.capture_num
+    assert a.sys_ticks == b.sys_ticks
+    assert a.timestamp_ns == b.timestamp_ns
+    assert ( a.channels == b.channels ).all()
+    assert ( a.histograms == b.histograms ).all()
+    assert ( a.ref_histograms == b.ref_histograms ).all()
+    assert ( a.hist_info == b.hist_info ).all()
+    assert a.obj.tobytes() == b.obj.tobytes()
+
+
+def test_recording_round_trip( tmp_path ):
+    path = str(tmp_path / "frames.bin")
+    recorded = frames(5)
+    with RecordingWriter(path) as recording:
+        for frame in recorded:
+            recording.write(frame)
+    with RecordingReader(path) as recording:
+        assert len(recording) == len(recorded)
+        for frame, replayed in zip(recorded, recording):
+            assertSameFrame(frame, replayed)
+        assert recording.findTime(recorded[2].timestamp_ns) == 2
+
+def test_replay_reuses_one_frame( tmp_path ):
+    path = str(tmp_path / "frames.bin")
+    recorded = frames(3)
+    with RecordingWriter(path) as recording:
+        for frame in recorded:
+            recording.write(frame)
+    with RecordingReader(path) as recording:
+        replayed = []
+        for frame in recording.replay(reuse_frame=True):
+            assertSameFrame(recorded[len(replayed)], frame)
+            replayed.append(frame)
+        assert len(replayed) == 3 and len({id(frame) for frame in replayed}) == 1
+        assert recording.frame(1, replayed[0]) is replayed[0]
+        assertSameFrame(replayed[0], recorded[1])
+
+def header( version=RECORDING_VERSION, record_size=FRAME_RECORD_DTYPE.itemsize ):
+    header = np.zeros(1, dtype=RECORDING_HEADER)
+    header['magic'] = RECORDING_MAGIC
+    header['version'] = version
+    header['record_size'] = record_size
+    return header.tobytes()
+
+def test_header_checks( tmp_path ):
+    path = tmp_path / "frames.bin"
+    path.write_bytes(header(version=RECORDING_VERSION + 1))
+    with pytest.raises(ValueError, match="unsupported recording version"):
+        RecordingReader(str(path))
+    path.write_bytes(header(record_size=FRAME_RECORD_DTYPE.itemsize - 4))
+    with pytest.raises(ValueError, match="record size"):
+        RecordingReader(str(path))
+    path.write_bytes(bytes(RECORDING_HEADER_SIZE))
+    with pytest.raises(ValueError, match="not a TMF8828 frame recording"):
+        RecordingReader(str(path))
+
+def test_recording_drops_a_partial_record( tmp_path ):
+    path = str(tmp_path / "frames.bin")
+    recorded = frames(3)
+    with RecordingWriter(path) as recording:
+        recording.write(recorded[0])
+    with open(path, "ab") as file:
+        file.write(b"partial")
+    with RecordingReader(path) as recording:
+        assert len(recording) == 1
+    with RecordingWriter(path) as recording:
+        recording.write(recorded[1])
+    with RecordingReader(path) as recording:
+        assert len(recording) == 2
+        assertSameFrame(recording.frame(1), recorded[1])
+
+def test_logconvert_round_trip( tmp_path ):
+    text = logText(frames(6))
+    log_path = tmp_path / "capture.txt"
+    log_path.write_text(text)
+    assert logconvert.convertLog(str(log_path), chunk_frames=4) == (6, 0)
+    assert logconvert.recordingToLog(str(tmp_path / "capture.bin"), str(tmp_path / "back.txt")) == 6
+    assert ( tmp_path / "back.txt" ).read_text() == text
+
+def test_logconvert_npz( tmp_path ):
+    recorded = frames(3)
+    log_path = tmp_path / "capture.txt"
+    log_path.write_text(logText(recorded))
+    assert logconvert.convertLog(str(log_path), str(tmp_path / "capture.npz")) == (3, 0)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["capture.npz", "capture.txt"]
+    with np.load(str(tmp_path / "capture.npz")) as data:
+        assert set(data.files) == set(FRAME_RECORD_DTYPE.names)
+        assert ( data['histograms'] == np.stack([frame.histograms for frame in recorded]) ).all()
+        assert ( data['obj']['distance_mm'][1] == recorded[1].obj['distance_mm'].ravel() ).all()
+
+def test_logconvert_skips_incomplete_frames():
+    recorded = frames(3)
+    text = logText(recorded)
+    # a #HIST line missing in the second frame
+    lines = text.splitlines(keepends=True)
+    first_obj = next(n for n, line in enumerate(lines) if line.startswith("#OBJ"))
+    del lines[first_obj + 3]
+    reader = logconvert.HistogramLogReader(lines)
+    records = np.concatenate(list(reader))
+    assert reader.frames == 2 and reader.skipped == 1
+    assert records['capture_num'].tolist() == [recorded[0].capture_num, recorded[2].capture_num]
+
+def test_logconvert_skips_frames_with_other_num_tdc():
+    recorded = frames(3)
+    lines = logText(recorded).splitlines(keepends=True)
+    first_obj = next(n for n, line in enumerate(lines) if line.startswith("#OBJ"))
+    info = next(n for n in range(first_obj, len(lines)) if lines[n].startswith("#HISTINFO"))
+    fields = lines[info].split(";")
+    fields[4] = "num_tdc: 4"
+    lines[info] = ";".join(fields)
+    reader = logconvert.HistogramLogReader(lines, chunk_frames=2)
+    records = np.concatenate(list(reader))
+    assert reader.frames == 2 and reader.skipped == 1
+    assert records['capture_num'].tolist() == [recorded[0].capture_num, recorded[2].capture_num]
@@ -0,0 +1,98 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_shared
+import tmf8828_synthetic as synthetic
+from tmf8828_shared import SharedFrameReader, SharedFrameWriter
+from conftest import views
+
+
+@pytest.fixture
+def name():
+    return f"tmf8828_test_{os.getpid()}"
+
+
+def test_shared_frames_round_trip( name ):
+    recorded = list(tof.stream_8x8_frames(views(synthetic.messages8x8(6))))
+    with SharedFrameWriter(name, slots=4) as writer, SharedFrameReader(name) as reader:
+        for frame in recorded:
+            writer.publish(frame)
+        assert reader.latest().capture_num == recorded[-1].capture_num
+        frames = [frame.capture_num for frame in reader.frames(timeout_s=0)]
+        assert frames == [frame.capture_num for frame in recorded[-4:]]
+        assert reader.missed == len(recorded) - 4
+
+def test_writer_does_not_replace_an_existing_segment( name ):
+    with SharedFrameWriter(name, slots=4) as writer:
+        with pytest.raises(FileExistsError):
+            SharedFrameWriter(name, slots=4)
+        frame = next(tof.stream_8x8_frames(views(synthetic.messages8x8(2))))
+        writer.publish(frame)
+        with SharedFrameReader(name) as reader:
+            assert reader.latest().capture_num == frame.capture_num
+
+def test_writer_replaces_a_stale_segment_on_request( name ):
+    stale = SharedFrameWriter(name, slots=4)
+    stale.shm.close()   # the publisher died without unlinking
+    with SharedFrameWriter(name, slots=8, replace=True) as writer:
+        with SharedFrameReader(name) as reader:
+            assert reader.slots == 8
+
+# runs code in a new python process, which has a resource tracker of its own,
+# returns its stderr
+def runPython( code ):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(tmf8828_shared.__file__))
+    result = subprocess.run([sys.executable, "-c", textwrap.dedent(code)], env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stderr
+
+def test_replace_and_read_leave_no_resource_tracker_warnings( name ):
+    stderr = runPython(f"""
+        from tmf8828_shared import SharedFrameReader, SharedFrameWriter
+        stale = SharedFrameWriter("{name}", slots=4)
+        stale.shm.close()
+        with SharedFrameWriter("{name}", slots=8, replace=True) as writer:
+            with SharedFrameReader("{name}") as reader:
+                assert reader.slots == 8
+    """)
+    assert stderr == ""
+    with pytest.raises(FileNotFoundError):
+        SharedFrameReader(name)
+
+def test_reader_process_does_not_unlink_the_segment( name ):
+    frame = next(tof.stream_8x8_frames(views(synthetic.messages8x8(1))))
+    with SharedFrameWriter(name, slots=4) as writer:
+        writer.publish(frame)
+        stderr = runPython(f"""
+            from tmf8828_shared import SharedFrameReader
+            with SharedFrameReader("{name}") as reader:
+                assert reader.latest().capture_num == {frame.capture_num}
+        """)
+        assert stderr == ""
+        with SharedFrameReader(name) as reader:
+            assert reader.last_seq == 1
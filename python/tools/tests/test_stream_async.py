@@ -0,0 +1,90 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+import asyncio
+import collections
+
+import pytest
+import zmq
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+
+
+# zmq.asyncio like socket over a SyntheticSocket
+class AsyncSyntheticSocket:
+    def __init__(self, messages):
+        self.sub = synthetic.SyntheticSocket(messages)
+
+    async def recv(self, flags=0, copy=True):
+        return self.sub.recv(flags, copy)
+
+    def close(self, linger=None):
+        pass
+
+
+async def take( frames, n ):
+    taken = []
+    async for frame in frames:
+        taken.append(frame)
+        if len(taken) == n:
+            break
+    return taken
+
+
+def test_stream_frames_async():
+    session = tof.Capture8x8Session()
+    frames = asyncio.run(take(tof.stream_8x8_frames_async(AsyncSyntheticSocket(synthetic.messages8x8(2)), session), 5))
+    assert [frame.capture_num for frame in frames] == [0, 4, 8, 12, 16]
+    assert session.frames == 5 and session.frames_dropped == 0
+
+def test_stream_frames_async_records_stats():
+    stats = tof.CaptureStats()
+    session = tof.Capture4x4Session(stats=stats)
+    frames = asyncio.run(take(tof.stream_4x4_frames_async(AsyncSyntheticSocket(synthetic.messages4x4(2)), session), 3))
+    assert [frame.capture_num for frame in frames] == [0, 1, 2]
+    received = sum(stats.messages.values())
+    assert stats.stage_count['receive'] == stats.stage_count['decode'] == stats.stage_count['assemble'] == received
+    assert stats.messages[tof.HISTOGRAM_ID_MEASUREMENT] > 0
+
+async def framesPerSensor( endpoints, n, sessions=None ):
+    counts = collections.Counter()
+    frames = tof.stream_sensors_8x8(endpoints, sessions)
+    try:
+        async for sensor, frame in frames:
+            assert isinstance(frame, tof.Tmf8828_frame)
+            counts[sensor] += 1
+            if all(counts[name] >= n for name in endpoints):
+                break
+    finally:
+        await frames.aclose()
+    return counts
+
+def test_stream_sensors_merges_all_sensors():
+    with synthetic.SyntheticPublisher() as left, synthetic.SyntheticPublisher() as right:
+        sessions = dict()
+        counts = asyncio.run(asyncio.wait_for(framesPerSensor({"left": left.uri, "right": right.uri}, 3, sessions), 10))
+    assert counts["left"] >= 3 and counts["right"] >= 3
+    assert sessions["left"].frames >= 3 and sessions["right"].frames >= 3
+
+def test_stream_sensors_raises_the_error_of_a_sensor():
+    with synthetic.SyntheticPublisher() as left:
+        with pytest.raises(zmq.ZMQError):
+            asyncio.run(asyncio.wait_for(framesPerSensor({"left": left.uri, "bogus": "bogus://nowhere"}, 3), 10))
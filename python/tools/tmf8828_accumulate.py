@@ -0,0 +1,162 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Accumulation of the last N 8x8 frames, for averaging histograms over time.
+#
+# FrameRingBuffer keeps the last capacity frames in one preallocated array of
+# recording records (see tmf8828_recording.FRAME_RECORD_DTYPE): histograms,
+# reference histograms, #OBJ entries, sys_ticks and host timestamps, next to it
+# the measurement statistics of every sub-capture (frame.stats). Adding a
+# frame overwrites the oldest one and updates the running sum and sum of squares
+# of every pixel bin, so sum / mean / variance over all buffered frames are
+# available without summing the frames again. Queries over the last n frames or
+# a sys_ticks range sum just those frames. sys_ticks is a 32 bit device counter,
+# ranges are compared modulo 2**32 so they work across its wrap.
+#
+#   ring = FrameRingBuffer(16)
+#   for frame in tof.stream_8x8_frames(sub):
+#       ring.append(frame)
+#       if ring.full:
+#           distance_mm, confidence = depth.estimateDepth(ring.mean(), ...)
+
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+from tmf8828_recording import FRAME_RECORD_DTYPE, frameToRecord, recordToFrame
+
+SYS_TICKS_MASK = 0xFFFFFFFF
+
+
+class FrameRingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.records = np.zeros(capacity, dtype=FRAME_RECORD_DTYPE)
+        # measurement statistics of the frames, [slot][c*2+s] like frame.stats
+        self.meas_stats = np.zeros((capacity, 2 * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE), dtype=tof.MEAS_STATS_DTYPE)
+        self.count   = 0            # frames in the buffer
+        self.next    = 0            # slot the next frame goes to
+        self.appended = 0           # frames appended in total
+        shape = (8, 8, tof.BINS_PER_TDC_CHANNEL)
+        # integer sums are exact, so adding and removing frames never drifts
+        # (histogram bins are 24 bit on the device, their squares fit easily)
+        self.hist_sum    = np.zeros(shape, dtype=np.int64)
+        self.hist_sum_sq = np.zeros(shape, dtype=np.int64)
+
+    @property
+    def full(self):
+        return self.count == self.capacity
+
+    def __len__(self):
+        return self.count
+
+    def append(self, frame):
+        rec = self.records[self.next]
+        if self.count == self.capacity:
+            old = rec['histograms'].astype(np.int64)
+            self.hist_sum -= old
+            self.hist_sum_sq -= old * old
+        else:
+            self.count += 1
+        frameToRecord(frame, rec)
+        self.meas_stats[self.next] = frame.stats
+        new = rec['histograms'].astype(np.int64)
+        self.hist_sum += new
+        self.hist_sum_sq += new * new
+        self.next = ( self.next + 1 ) % self.capacity
+        self.appended += 1
+
+    def clear(self):
+        self.count = 0
+        self.next = 0
+        self.hist_sum.fill(0)
+        self.hist_sum_sq.fill(0)
+
+    # slots of the last n frames (all with None), oldest first
+    def _slots(self, n=None):
+        n = self.count if n is None else min(n, self.count)
+        return ( np.arange(self.next - n, self.next) ) % self.capacity
+
+    # window( n=None )
+    # the records of the last n frames (all with None) in capture order, a copy
+    def window(self, n=None):
+        return self.records[self._slots(n)]
+
+    # measurement statistics of the last n frames (n, 8), oldest first, a copy
+    def statsWindow(self, n=None):
+        return self.meas_stats[self._slots(n)]
+
+    # the last n frames as Tmf8828_frame, oldest first
+    def frames(self, n=None):
+        frames = []
+        for slot in self._slots(n):
+            frame = recordToFrame(self.records[slot])
+            frame.stats[:] = self.meas_stats[slot]
+            frames.append(frame)
+        return frames
+
+    # sum( n=None )
+    # (8, 8, 128) sum of the histograms of the last n frames, all buffered
+    # frames come from the running sum
+    def sum(self, n=None):
+        if n is None or n >= self.count:
+            return self.hist_sum.copy()
+        return self.records['histograms'][self._slots(n)].sum(axis=0, dtype=np.int64)
+
+    def mean(self, n=None):
+        n = self.count if n is None else min(n, self.count)
+        return self.sum(n) / max(n, 1)
+
+    # population variance of every pixel bin over the last n frames
+    def variance(self, n=None):
+        n = self.count if n is None else min(n, self.count)
+        if n == self.count:
+            total, total_sq = self.hist_sum, self.hist_sum_sq
+        else:
+            hist = self.records['histograms'][self._slots(n)].astype(np.int64)
+            total, total_sq = hist.sum(axis=0), ( hist * hist ).sum(axis=0)
+        n = max(n, 1)
+        mean = total / n
+        return np.maximum(total_sq / n - mean * mean, 0.0)
+
+    # ticksWindow( first_ticks, last_ticks )
+    # slots of the buffered frames with first_ticks <= sys_ticks < last_ticks, oldest first.
+    # The range goes from first_ticks forward to last_ticks modulo 2**32, across a wrap
+    # of the counter (first_ticks 0xFFFFF000, last_ticks 0x1000 is 8192 ticks long)
+    def ticksWindow(self, first_ticks, last_ticks):
+        slots = self._slots()
+        length = ( last_ticks - first_ticks ) & SYS_TICKS_MASK
+        # uint32 differences wrap like the counter
+        since_first = self.records['sys_ticks'][slots] - np.uint32(first_ticks & SYS_TICKS_MASK)
+        return slots[since_first < length]
+
+    # sum of the histograms of the frames in a sys_ticks range, and their number
+    def sumTicks(self, first_ticks, last_ticks):
+        slots = self.ticksWindow(first_ticks, last_ticks)
+        return self.records['histograms'][slots].sum(axis=0, dtype=np.int64), len(slots)
+
+    # (8, 8, 2) mean #OBJ distance of the last n frames over the frames with an
+    # object (confidence > 0), 0 where no frame had one
+    def objDistanceMean(self, n=None):
+        obj = self.records['obj'][self._slots(n)].reshape(-1, tof.OBJ_PIXELS, tof.OBJ_PER_PIXEL)
+        valid = obj['confidence'] > 0
+        count = valid.sum(axis=0)
+        total = np.where(valid, obj['distance_mm'], 0).sum(axis=0)
+        mean = np.divide(total, count, out=np.zeros(total.shape), where=count > 0)
+        return mean.reshape(8, 9, tof.OBJ_PER_PIXEL)[:, :8]
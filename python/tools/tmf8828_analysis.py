@@ -0,0 +1,269 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Per-histogram analysis of 8x8 frames, off the receive thread.
+#
+# The kernels below work on any array of histograms (..., 128) at once, e.g.
+# frame.channels (80, 128) or frame.histograms (8, 8, 128), and return one value
+# per histogram.
+#
+# AnalysisStage runs an analysis function on every frame in a worker thread:
+#  - kernels (and any other function declared vectorized) get all 80 channel
+#    histograms of a frame in one call
+#  - any other python function is called per histogram, like the do_function
+#    of getAllHistogramsIn8x8Mode, in a process pool
+# Frames are handed over through a bounded queue. When analysis falls behind the
+# queue fills up and further frames are dropped (and counted), receiving never
+# waits for analysis. An exception of the analysis function ends the stage,
+# get() / iterating raise it after the frames analyzed before.
+#
+#   stage = AnalysisStage(crosstalk)
+#   stage.receive(tof.connectToRaspi())
+#   for frame, crosstalks in stage:
+#       ...
+
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+
+import zmq
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+
+CROSSTALK_BINS = slice(5, 20)    # same window as calc_crosstalk
+AMBIENT_BINS   = slice(0, 10)    # bins before the laser pulse
+
+
+def crosstalk(h):
+    return h[..., CROSSTALK_BINS].max(axis=-1)
+
+def ambient(h):
+    return h[..., AMBIENT_BINS].mean(axis=-1)
+
+# bin number of the maximum after the crosstalk window
+def peak(h):
+    return h[..., CROSSTALK_BINS.stop:].argmax(axis=-1) + CROSSTALK_BINS.stop
+
+KERNELS = {
+    'crosstalk': crosstalk,
+    'ambient':   ambient,
+    'peak':      peak,
+}
+
+# per-histogram functions of the capture script that have a vectorized kernel
+LEGACY_KERNELS = {
+    tof.calc_crosstalk: crosstalk,
+}
+
+
+def _apply_per_histogram(function, channels):
+    return [function(h) for h in channels.tolist()]
+
+# the pool processes are started fresh, forking would copy the receive thread's
+# zmq sockets and locks into them
+def _pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+RECEIVE_POLL_MS = 100     # the receive thread checks for close() that often
+
+
+class AnalysisStage:
+    # function     kernel name, kernel, or any function of one histogram (list of 128 ints)
+    # vectorized   True if function takes the (80, 128) array of a frame, detected for
+    #              the kernels above
+    # queue_size   frames waiting for analysis before frames get dropped
+    # processes    size of the process pool for per-histogram functions, None for os.cpu_count(),
+    #              they must be picklable (no lambdas or local functions)
+    # stats        tof.CaptureStats, records the frame queue depth as 'analysis' and the
+    #              analysis time per frame as stage 'callback'
+    def __init__(self, function='crosstalk', vectorized=None, queue_size=8, result_queue_size=64, processes=None, stats=None):
+        function = KERNELS.get(function, function)
+        function = LEGACY_KERNELS.get(function, function)
+        if vectorized is None:
+            vectorized = function in KERNELS.values()
+        self.function = function
+        self.vectorized = vectorized
+        self.stats = stats
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue(maxsize=result_queue_size)
+        if vectorized:
+            self.pool = None
+            self.in_flight = 1
+        else:
+            # the pool sends the function to its processes: fail here if it cannot
+            # be pickled (e.g. a lambda), not in the worker
+            pickle.dumps(function)
+            self.in_flight = processes or os.cpu_count() or 1
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.in_flight, mp_context=_pool_context())
+
+        self.submitted       = 0
+        self.dropped         = 0      # frames not analyzed because the queue was full
+        self.processed       = 0
+        self.max_queue_depth = 0
+
+        self.stopped = False
+        self.error = None             # exception that ended the analysis
+        self.receiver = None
+        self.receiver_polled = False
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    # hand a frame over for analysis, returns False if it was dropped
+    def submit(self, frame):
+        self.submitted += 1
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        depth = self.frames.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        if self.stats is not None:
+            self.stats.queueDepth('analysis', depth)
+        return True
+
+    # frames waiting for analysis
+    @property
+    def backlog(self):
+        return self.frames.qsize()
+
+    # receive( sub, session=None )
+    # starts a thread receiving frames from sub (see tof.stream_8x8_frames) and
+    # submitting them, the stage ends when the stream ends. A zmq socket is
+    # polled, close() then stops the thread within RECEIVE_POLL_MS. Other
+    # sources are only checked between frames and should not block forever
+    # (e.g. a TofDeviceReader with timeout_ms).
+    def receive(self, sub, session=None):
+        polled = isinstance(sub, zmq.Socket)
+
+        def run():
+            source = self._poll(sub) if polled else sub
+            for frame in tof.stream_8x8_frames(source, session):
+                if self.stopped:
+                    return
+                self.submit(frame)
+            # the worker may be gone already (close(), errors), do not wait for it forever
+            while not self.stopped:
+                try:
+                    self.frames.put(None, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+        self.receiver = threading.Thread(target=run, daemon=True)
+        self.receiver_polled = polled
+        self.receiver.start()
+        return self.receiver
+
+    # the messages of the zmq socket sub until close()
+    def _poll(self, sub):
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        while not self.stopped:
+            if poller.poll(RECEIVE_POLL_MS):
+                yield tof.Tmf8820_msg_view(sub.recv(copy=False))
+
+    # no more frames will be submitted
+    def finish(self):
+        self.frames.put(None)
+
+    # analyzes frames until the end marker, close() or an error of the analysis
+    # function (kept in error), the results always end with None
+    def _work(self):
+        pending = collections.deque()
+        try:
+            while not self.stopped:
+                frame = self.frames.get()
+                if frame is None or self.stopped:
+                    break
+                if self.vectorized:
+                    t0 = time.perf_counter_ns()
+                    values = self.function(frame.channels)
+                    if self.stats is not None:
+                        self.stats.add('callback', time.perf_counter_ns() - t0)
+                    self._deliver(frame, values)
+                    continue
+                pending.append((frame, self.pool.submit(_apply_per_histogram, self.function, frame.channels)))
+                if len(pending) >= self.in_flight:
+                    frame, future = pending.popleft()
+                    self._deliver(frame, future.result())
+            while pending and not self.stopped:
+                frame, future = pending.popleft()
+                self._deliver(frame, future.result())
+        except Exception as error:
+            self.error = error
+        for _, future in pending:
+            future.cancel()
+        self.results.put(None)
+
+    def _deliver(self, frame, values):
+        self.processed += 1
+        self.results.put((frame, values))
+
+    # (frame, values) of the next analyzed frame, values are indexed by histogram
+    # number like the do_function results; None after the last frame. Raises
+    # the error that ended the analysis instead of returning None.
+    def get(self, timeout=None):
+        result = self.results.get(timeout=timeout)
+        if result is None and self.error is not None:
+            raise self.error
+        return result
+
+    def __iter__(self):
+        while True:
+            result = self.get()
+            if result is None:
+                return
+            yield result
+
+    def close(self):
+        self.stopped = True
+        # wake the worker with the end marker, collecting its results meanwhile:
+        # with nobody reading them both queues may be full
+        marker = False
+        while self.worker.is_alive():
+            if not marker:
+                try:
+                    self.frames.put_nowait(None)
+                    marker = True
+                except queue.Full:
+                    pass
+            try:
+                self.results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        # a polled receiver ends within RECEIVE_POLL_MS, any other one with
+        # its next frame or end marker
+        if self.receiver is not None:
+            self.receiver.join(timeout=None if self.receiver_polled else 1.0)
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,210 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Host side benchmarks for tmf8828_get_all_histograms_in_8x8_mode_zmq.py.
+# No EVM is needed, the messages come from tmf8828_synthetic.py.
+#
+#   python tmf8828_benchmark.py [--seconds 1.0] [--json results.json]
+#
+# --json writes all rates to a file, e.g. to track them per commit on CI.
+
+import argparse
+import io
+import json
+import time
+import tracemalloc
+import zmq
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+import tmf8828_synthetic as synthetic
+
+BENCHMARK_SECONDS = 1.0
+
+def make_histogram_msg(capture_num=0, sub_capture=0):
+    return synthetic.histogramMessage(capture_num, sub_capture, synthetic.SyntheticScene().histogramBins(0))
+
+# message decoding as done before Tmf8820_msg_view, kept for comparison
+def legacy_decode(buf):
+    data = bytearray(buf) + bytearray([0] * tof.MAX_MSG_SIZE)
+    return tof.Tmf8820_msg.from_buffer_copy(data)
+
+def run_for(func, seconds=None):
+    # returns calls per second
+    seconds = seconds or BENCHMARK_SECONDS
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while True:
+        for _ in range(100):
+            func()
+        count += 100
+        now = time.perf_counter()
+        if now >= end:
+            return count / (now - start)
+
+# like run_for for slower functions, calls func once per round
+def run_calls_for(func, seconds=None):
+    seconds = seconds or BENCHMARK_SECONDS
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        now = time.perf_counter()
+        if now - start >= seconds:
+            return count / (now - start)
+
+def print_rates(title, results, unit):
+    print(title)
+    for name, rate in results:
+        print(f"  {name:32} {rate:12.1f} {unit}  {rate / results[0][1]:6.1f}x")
+    return {name: rate for name, rate in results}
+
+def benchmark_decode():
+    buf = make_histogram_msg()
+    frame = zmq.Frame(buf)
+
+    # decode and read all channel histograms, as the capture loops do
+    def legacy():
+        hist = legacy_decode(buf).hist_msg
+        return [hist.bins[tdc][:tof.BINS_PER_TDC_CHANNEL] for tdc in range(hist.num_tdc)]
+
+    def union_copy():
+        hist = tof.Tmf8820_msg(buf).hist_msg
+        return [hist.bins[tdc][:tof.BINS_PER_TDC_CHANNEL] for tdc in range(hist.num_tdc)]
+
+    def view():
+        msg = tof.Tmf8820_msg_view(frame)
+        return msg.hist_bins[:, :tof.BINS_PER_TDC_CHANNEL].tolist()
+
+    return print_rates("histogram message decode", [
+        ("legacy padded copy",       run_for(legacy)),
+        ("Tmf8820_msg",              run_for(union_copy)),
+        ("Tmf8820_msg_view (Frame)", run_for(view)),
+    ], "msg/s")
+
+def make_frame():
+    session = tof.Capture8x8Session()
+    for msg in synthetic.messages8x8(2):
+        frame = session.feed(tof.Tmf8820_msg_view(msg))
+        if frame is not None:
+            return frame
+
+# log text formatting as done before HistogramLogWriter, kept for comparison
+def legacy_format_frame(frame):
+    logString = ""
+    for slot, (capture_num, histogram_type, num_tdc, num_bins) in enumerate(frame.hist_info.tolist()):
+        capture, sub_capture = divmod(slot, 2)
+        logString += f"#HISTINFO;Transaction ID: {capture_num};Capture: {capture_num % tof.NUMBER_OF_CAPTURES_IN_8X8_MODE};Type: {histogram_type};num_tdc: {num_tdc};num_bins: {num_bins};sub_capture: {sub_capture}\n"
+        for tdc in range(num_tdc):
+            currentHistogram = capture * tof.HISTOGRAMS_PER_CAPTURE_IN_8X8 + sub_capture * tof.HISTOGRAMS_PER_SUBCAPTURE + tdc * tof.NUMBER_OF_TDC_CHANNELS
+            for channel in (0, 1):
+                binString = ""
+                for binValue in frame.channels[currentHistogram + channel].tolist():
+                    binString += f";{binValue}"
+                logString += f"#HIST{tof.mapHistogramNumber(currentHistogram + channel)}{binString}\n"
+    logString += f"#OBJ;12345678;0;8;8"
+    for confidence, distance_mm, channel, ch_target_idx, sub_capture in frame.obj.reshape(-1).tolist():
+        logString += f";{distance_mm};{confidence}"
+    logString += f"\n"
+    return logString
+
+def benchmark_log_format():
+    frame = make_frame()
+
+    def writer():
+        log = tof.HistogramLogWriter(io.StringIO())
+        log.writeFrame(frame)
+        return log.file.getvalue()
+
+    if writer() != legacy_format_frame(frame):
+        print("HistogramLogWriter output differs from the legacy format")
+
+    return print_rates("8x8 frame log formatting", [
+        ("legacy string concatenation", run_for(lambda: legacy_format_frame(frame))),
+        ("HistogramLogWriter",          run_for(writer)),
+    ], "frames/s")
+
+# end to end: receive (SyntheticSocket, no network), decode, assemble and format
+def benchmark_capture():
+    sock8x8 = synthetic.SyntheticSocket(list(synthetic.messages8x8(4)))
+    sock4x4 = synthetic.SyntheticSocket(list(synthetic.messages4x4(16, calibration=False)))
+    stream8x8 = tof.stream_8x8_frames(sock8x8, tof.Capture8x8Session(reuse_frames=True))
+    stream4x4 = tof.stream_4x4_frames(sock4x4, tof.Capture4x4Session(reuse_frames=True))
+    zones = tof.zoneMask(range(tof.HISTOGRAMS_IN_4X4_MODE))
+
+    return print_rates("end to end capture", [
+        ("getAllHistogramsIn8x8Mode",    run_calls_for(lambda: tof.getAllHistogramsIn8x8Mode(sock8x8))),
+        ("  with do_function",           run_calls_for(lambda: tof.getAllHistogramsIn8x8Mode(sock8x8, tof.calc_crosstalk))),
+        ("stream_8x8_frames",            run_calls_for(lambda: next(stream8x8))),
+        ("getAllHistogramsIn4x4Mode",    run_calls_for(lambda: tof.getAllHistogramsIn4x4Mode(sock4x4, range(20)))),
+        ("stream_4x4_frames",            run_calls_for(lambda: tof.selectZones(next(stream4x4), zones))),
+    ], "frames/s")
+
+# tracemalloc peak of one capture call, and memory kept per streamed frame
+def benchmark_memory():
+    def peak(func):
+        func()      # warm up caches (format strings, lookup tables)
+        tracemalloc.start()
+        func()
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return size
+
+    def retained(session_class, messages, frames=50):
+        stream = tof.stream_frames(synthetic.SyntheticSocket(messages), session_class())
+        kept = [next(stream)]
+        tracemalloc.start()
+        for _ in range(frames):
+            kept.append(next(stream))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / frames
+
+    sock8x8 = synthetic.SyntheticSocket(list(synthetic.messages8x8(2)))
+    sock4x4 = synthetic.SyntheticSocket(list(synthetic.messages4x4(4, calibration=False)))
+    results = {
+        "getAllHistogramsIn8x8Mode peak": peak(lambda: tof.getAllHistogramsIn8x8Mode(sock8x8)),
+        "getAllHistogramsIn4x4Mode peak": peak(lambda: tof.getAllHistogramsIn4x4Mode(sock4x4, range(20))),
+        "8x8 frame retained":             retained(tof.Capture8x8Session, list(synthetic.messages8x8(2))),
+        "4x4 frame retained":             retained(tof.Capture4x4Session, list(synthetic.messages4x4(4, calibration=False))),
+    }
+    print("memory")
+    for name, size in results.items():
+        print(f"  {name:32} {size / 1024:12.1f} KiB")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Host side benchmarks of the TMF8828 capture tools")
+    parser.add_argument("--seconds", type=float, default=BENCHMARK_SECONDS, help="run time of every measurement")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+    BENCHMARK_SECONDS = args.seconds
+
+    results = {
+        "decode":     benchmark_decode(),
+        "log_format": benchmark_log_format(),
+        "capture":    benchmark_capture(),
+        "memory":     benchmark_memory(),
+    }
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,196 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+
+# Per-sensor calibration tables for 8x8 capture, cached on disk.
+#
+# calibrate() derives the tables from N frames taken without a target in the
+# crosstalk range (cover glass only, or open space), from the summed histograms
+# of all frames at once:
+#   crosstalk       (8, 8, 128) crosstalk histogram of every pixel: ambient
+#                   subtracted mean of the crosstalk window bins, 0 elsewhere
+#   crosstalk_peak  (8, 8) calc_crosstalk of the mean pixel histograms: maximum of
+#                   the crosstalk window, ambient light included
+#   zero_bins       (8, 8) zero offset bin of every pixel, from its reference channel
+# The tables are cached as <cache_dir>/tmf8828_<uid>.npz, keyed by the device
+# UID the driver exposes in the device_uid sysfs attribute. When the sensor is
+# connected to another host (the EVM) pass the UID of the sensor instead.
+# A cached calibration is only used for the UID it was taken with.
+#
+# apply() removes ambient light and crosstalk from the pixel histograms of a
+# frame, depth() estimates the distances with the cached zero offsets (see
+# tmf8828_depth), so no reference peak is searched per frame.
+#
+#   calibration = getCalibration(sub, uid)     cached, or captured and cached
+#   for frame, histograms in stream_calibrated_frames(sub, calibration):
+#       ...
+
+import argparse
+import glob
+import itertools
+import os
+import re
+import sys
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+from tmf8828_analysis import AMBIENT_BINS, CROSSTALK_BINS
+from tmf8828_depth import MM_PER_BIN, MIN_CONFIDENCE, PIXEL_REF_CHANNELS, estimateDepth, referenceZeroBins
+
+CALIBRATION_VERSION = 2
+CALIBRATION_FRAMES  = 16
+CACHE_DIR           = os.path.join(os.path.expanduser("~"), ".cache", "tmf8828")
+# device_uid of the sensor on I2C address 0x41, see the device tree overlays
+DEVICE_UID_PATHS    = "/sys/bus/i2c/devices/*-0041/device_uid"
+
+
+class Calibration:
+    def __init__(self, crosstalk, crosstalk_peak, zero_bins, frames=0, uid=None):
+        self.crosstalk      = crosstalk.astype(np.float32)
+        self.crosstalk_peak = crosstalk_peak.astype(np.float64)
+        self.zero_bins      = zero_bins.astype(np.float64)
+        self.frames         = frames        # number of frames the tables were derived from
+        self.uid            = uid
+
+    # apply( frame, out=None )
+    # (8, 8, 128) float32 pixel histograms of a Tmf8828_frame with the ambient
+    # light and the crosstalk removed, into out if given
+    def apply(self, frame, out=None):
+        if out is None:
+            out = np.empty(self.crosstalk.shape, dtype=np.float32)
+        out[...] = frame.histograms
+        out -= out[..., AMBIENT_BINS].mean(axis=-1, keepdims=True)
+        out -= self.crosstalk
+        return out
+
+    # depth( frame, mm_per_bin=MM_PER_BIN, min_confidence=MIN_CONFIDENCE )
+    # (8, 8) distance_mm and confidence of a Tmf8828_frame, see tmf8828_depth.depthMap
+    def depth(self, frame, mm_per_bin=MM_PER_BIN, min_confidence=MIN_CONFIDENCE):
+        distance_mm, confidence, _ = estimateDepth(frame.histograms, self.zero_bins, mm_per_bin, self.crosstalk, min_confidence)
+        return distance_mm, confidence
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # write a complete file and rename it, a concurrent reader never sees half of it
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez(file, version=CALIBRATION_VERSION, uid=self.uid or "", frames=self.frames,
+                     crosstalk=self.crosstalk, crosstalk_peak=self.crosstalk_peak, zero_bins=self.zero_bins)
+        os.replace(tmp_path, path)
+
+    # load( path )
+    # the calibration saved in path, None if there is none or it is of another version
+    @classmethod
+    def load(cls, path):
+        try:
+            with np.load(path) as data:
+                if int(data['version']) != CALIBRATION_VERSION:
+                    return None
+                return cls(data['crosstalk'], data['crosstalk_peak'], data['zero_bins'], int(data['frames']), str(data['uid']) or None)
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+# calibrate( frames, uid=None )
+# the Calibration of an iterable of Tmf8828_frame (e.g. the first N frames of stream_8x8_frames)
+def calibrate( frames, uid=None ):
+    hist_sum = np.zeros((8, 8, tof.BINS_PER_TDC_CHANNEL), dtype=np.int64)
+    ref_sum  = np.zeros((len(tof.REF_HISTOGRAM_NUMBERS), tof.BINS_PER_TDC_CHANNEL), dtype=np.int64)
+    n = 0
+    for frame in frames:
+        hist_sum += frame.histograms
+        ref_sum  += frame.ref_histograms
+        n += 1
+    if n == 0:
+        raise ValueError("no frames to calibrate with")
+    mean = hist_sum / n
+    crosstalk_peak = mean[..., CROSSTALK_BINS].max(axis=-1)
+    mean -= mean[..., AMBIENT_BINS].mean(axis=-1, keepdims=True)
+    crosstalk = np.zeros_like(mean)
+    crosstalk[..., CROSSTALK_BINS] = np.maximum(mean[..., CROSSTALK_BINS], 0)
+    zero_bins = referenceZeroBins(ref_sum / n)[PIXEL_REF_CHANNELS]
+    return Calibration(crosstalk, crosstalk_peak, zero_bins, n, uid)
+
+# readDeviceUid( path=DEVICE_UID_PATHS )
+# the UID string of the local sensor from sysfs (path may be a glob pattern),
+# None without a sensor on this host
+def readDeviceUid( path=DEVICE_UID_PATHS ):
+    for uid_path in sorted(glob.glob(path)):
+        try:
+            with open(uid_path, "r") as file:
+                uid = file.read().strip()
+        except OSError:         # the driver returns EIO when the device does not respond
+            continue
+        if uid:
+            return uid
+    return None
+
+def cachePath( uid, cache_dir=CACHE_DIR ):
+    return os.path.join(cache_dir, "tmf8828_" + re.sub(r"[^\w.-]", "_", uid) + ".npz")
+
+# getCalibration( sub, uid=None, cache_dir=CACHE_DIR, frames=CALIBRATION_FRAMES, session=None, recalibrate=False )
+# the cached Calibration of the sensor uid (by default the local one), else
+# one from the next frames frames of sub, which is then cached. Without a UID
+# nothing is cached. None if the stream ended before a frame was complete.
+# Different UIDs may map to the same cache file: a cached calibration of
+# another UID is replaced.
+def getCalibration( sub, uid=None, cache_dir=CACHE_DIR, frames=CALIBRATION_FRAMES, session=None, recalibrate=False ):
+    if uid is None:
+        uid = readDeviceUid()
+    if uid is not None and not recalibrate:
+        calibration = Calibration.load(cachePath(uid, cache_dir))
+        if calibration is not None and calibration.uid == uid:
+            return calibration
+    try:
+        calibration = calibrate(itertools.islice(tof.stream_8x8_frames(sub, session), frames), uid)
+    except ValueError:
+        return None
+    if uid is not None:
+        calibration.save(cachePath(uid, cache_dir))
+    return calibration
+
+# stream_calibrated_frames( sub, calibration, session=None )
+# stream_8x8_frames yielding every frame with its calibration.apply()
+# histograms. The histograms array is reused, it is only valid until the next frame.
+def stream_calibrated_frames( sub, calibration, session=None ):
+    histograms = np.empty(calibration.crosstalk.shape, dtype=np.float32)
+    for frame in tof.stream_8x8_frames(sub, session):
+        yield frame, calibration.apply(frame, histograms)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate a TMF8828 in 8x8 mode and cache the tables per sensor")
+    parser.add_argument("--uid", help="device UID, default: device_uid in sysfs of this host")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--frames", type=int, default=CALIBRATION_FRAMES, help="frames to calibrate with")
+    parser.add_argument("--recalibrate", action="store_true", help="ignore a cached calibration")
+    args = parser.parse_args()
+
+    zmqSocket = tof.connectToRaspi()
+    calibration = getCalibration(zmqSocket, args.uid, args.cache_dir, args.frames, recalibrate=args.recalibrate)
+    zmqSocket.close()
+    if calibration is None:
+        print("#ERROR;No frame received. Exiting.")
+        sys.exit(1)
+
+    print("Calibration of", calibration.uid or "unknown device", "from", calibration.frames, "frames")
+    print("Pixel crosstalks", calibration.crosstalk_peak.round(1).ravel().tolist())
+    print("minimum crosstalk", calibration.crosstalk_peak.min())
+    print("Zero offset bins", calibration.zero_bins.round(2).ravel().tolist())
@@ -0,0 +1,105 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Host side distance estimation from the histograms of an 8x8 frame.
+#
+# All pixels are processed at once on the (8, 8, 128) histograms of a frame:
+#  1. zero offset: the reference channel of every capture / sub-capture sees the
+#     laser pulse, the position of its peak is distance 0 for the pixels
+#     measured with it
+#  2. ambient light: the mean of the bins before the pulse is subtracted
+#  3. crosstalk: a crosstalk histogram per pixel (e.g. from calibration) is
+#     subtracted, without one the bins of the crosstalk peak are not searched
+#  4. peak: the maximum of the remaining bins, refined to a fraction of a bin
+#     by fitting a parabola through it and its neighbours
+#  5. distance_mm = ( peak - zero offset ) * mm_per_bin
+# The confidence is the peak height over the shot noise of the ambient light.
+#
+#   distance_mm, confidence = depthMap(frame)
+#   error_mm = compareWithObj(distance_mm, confidence, frame)
+
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+from tmf8828_analysis import AMBIENT_BINS, CROSSTALK_BINS
+
+MM_PER_BIN     = 37.5     # 250 ps bins
+MIN_CONFIDENCE = 6.0      # peaks below are no object, distance 0 like in the #OBJ results
+
+# reference channel (index into frame.ref_histograms) of every pixel
+PIXEL_REF_CHANNELS = ( tof.PIXEL_HISTOGRAM_NUMBERS // tof.HISTOGRAMS_PER_SUBCAPTURE ).reshape(8, 8)
+
+
+# subBinPeak( h, peak )
+# fractional bin of the peaks at integer bins peak (...) of histograms h (..., bins)
+# by a parabola through the peak bin and its neighbours
+def subBinPeak( h, peak ):
+    peak = np.clip(peak, 1, h.shape[-1] - 2)
+    left   = np.take_along_axis(h, peak[..., None] - 1, axis=-1)[..., 0]
+    center = np.take_along_axis(h, peak[..., None], axis=-1)[..., 0]
+    right  = np.take_along_axis(h, peak[..., None] + 1, axis=-1)[..., 0]
+    curvature = left - 2 * center + right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature < 0, 0.5 * ( left - right ) / curvature, 0.0)
+    return peak + np.clip(offset, -0.5, 0.5)
+
+# zero offset bin of every reference histogram (..., 128)
+def referenceZeroBins( ref_histograms ):
+    ref = ref_histograms.astype(np.float64)
+    ref -= ref[..., AMBIENT_BINS].mean(axis=-1, keepdims=True)
+    return subBinPeak(ref, ref.argmax(axis=-1))
+
+# estimateDepth( histograms, zero_bins, mm_per_bin=MM_PER_BIN, crosstalk=None, min_confidence=MIN_CONFIDENCE )
+# the steps above for any histograms (..., 128) with the zero offset bins
+# broadcastable to (...), returns distance_mm, confidence and the peak bins
+def estimateDepth( histograms, zero_bins, mm_per_bin=MM_PER_BIN, crosstalk=None, min_confidence=MIN_CONFIDENCE ):
+    h = histograms.astype(np.float64)
+    ambient = h[..., AMBIENT_BINS].mean(axis=-1)
+    h -= ambient[..., None]
+    if crosstalk is not None:
+        h -= crosstalk
+        first = np.floor(np.min(zero_bins)).astype(int) + 1
+    else:
+        first = CROSSTALK_BINS.stop
+    search = h[..., first:]
+    peak = subBinPeak(h, search.argmax(axis=-1) + first)
+    height = search.max(axis=-1)
+    confidence = np.maximum(height, 0) / np.sqrt(np.maximum(ambient, 1))
+    distance_mm = ( peak - zero_bins ) * mm_per_bin
+    found = confidence >= min_confidence
+    distance_mm = np.where(found, distance_mm, 0.0)
+    confidence = np.where(found, confidence, 0.0)
+    return distance_mm, confidence, peak
+
+# depthMap( frame, mm_per_bin=MM_PER_BIN, crosstalk=None, min_confidence=MIN_CONFIDENCE )
+# (8, 8) distance_mm and confidence of a Tmf8828_frame, crosstalk is None or
+# the (8, 8, 128) crosstalk histograms of the pixels
+def depthMap( frame, mm_per_bin=MM_PER_BIN, crosstalk=None, min_confidence=MIN_CONFIDENCE ):
+    zero_bins = referenceZeroBins(frame.ref_histograms)[PIXEL_REF_CHANNELS]
+    distance_mm, confidence, _ = estimateDepth(frame.histograms, zero_bins, mm_per_bin, crosstalk, min_confidence)
+    return distance_mm, confidence
+
+# compareWithObj( distance_mm, confidence, frame )
+# (8, 8) difference of distance_mm to the distance of object 0 of the #OBJ
+# results of the same frame, nan where either has no object
+def compareWithObj( distance_mm, confidence, frame ):
+    obj_distance = frame.distance_map[..., 0]
+    valid = ( confidence > 0 ) & ( frame.confidence_map[..., 0] > 0 )
+    return np.where(valid, distance_mm - obj_distance, np.nan)
@@ -18,14 +18,28 @@
 # * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
 # *****************************************************************************
 
+import asyncio
+import collections
 import ctypes
+import errno
+import io
+import os
+import select
+import sys
+import threading
+import time
+import numpy as np
 import zmq
+import zmq.asyncio
 
 RASPI_IP_ADDR  = '169.254.0.2'
 RASPI_ZMQ_PORT = 8083
 
 ZMQ_URI = "tcp://{}:{}".format(RASPI_IP_ADDR, RASPI_ZMQ_PORT)
 
+# char device of the tmf882x linux driver, streams the same messages as the EVM zmq server
+TOF_DEVICE = "/dev/tof"
+
 # constants for zmq message parsing
 MAX_MSG_SIZE     = 8192
 MAX_NUM_RESULTS  = 36
@@ -42,6 +56,9 @@ HISTOGRAMS_PER_SUBCAPTURE            = 10
 NUMBER_OF_TDC_CHANNELS               = 2
 BINS_PER_TDC_CHANNEL                 = 128
 MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES = 100
+CAPTURE_NUM_WRAP                     = 256    # capture_num / result_num are 8 bit counters on the device
+MAX_RECOVERIES_WITHOUT_FRAME         = 8      # recovered errors in a row before capture() gives up by default
+FRAME_RECEIVED_8X8                   = ( 1 << 2 * NUMBER_OF_CAPTURES_IN_8X8_MODE ) - 1   # all histogram messages of a sequence
 
 class Tmf8820_msg_header(ctypes.Structure):
     _fields_ = [
@@ -112,11 +129,92 @@ class Tmf8820_msg(ctypes.Union):
             ('msg_buf', ctypes.c_byte * MAX_MSG_SIZE),
     ]
     def __new__(cls, buf):
-        data = bytearray(buf) + bytearray([0] * MAX_MSG_SIZE)
-        return cls.from_buffer_copy(data)
+        # ctypes zero-initializes the union, so only the received bytes need copying
+        msg = super().__new__(cls)
+        data = memoryview(buf).cast('B')
+        size = min(len(data), MAX_MSG_SIZE)
+        memoryview(msg).cast('B')[:size] = data[:size]
+        return msg
     def __init__(self, buf):
         pass
 
+# fixed size part of the histogram and result messages (everything up to the arrays)
+class Tmf8820_msg_histogram_header(ctypes.Structure):
+    _fields_ = Tmf8820_msg_histogram._fields_[:-1]
+
+class Tmf8820_msg_meas_results_header(ctypes.Structure):
+    _fields_ = Tmf8820_msg_meas_results._fields_[:-1]
+
+HISTOGRAM_BINS_OFFSET = Tmf8820_msg_histogram.bins.offset
+MEAS_RESULTS_OFFSET   = Tmf8820_msg_meas_results.results.offset
+MEAS_RESULT_DTYPE     = np.dtype(Tmf8820_meas_result)
+MEAS_STATS_DTYPE      = np.dtype(Tmf8820_msg_meas_stats)
+
+class Tmf8820_msg_view:
+    # Decodes a message in place, without padding it to MAX_MSG_SIZE first.
+    # buf is anything supporting the buffer protocol (bytes, zmq.Frame received
+    # with copy=False, a memoryview into a larger read buffer ...).
+    # Only the small fixed size headers are copied into ctypes structures, the
+    # histogram bins and measurement results are numpy views of buf, so they
+    # are only valid as long as buf is not modified.
+    # Each property decodes again, bind the result to a local when used often.
+    __slots__ = ('buf', 'hdr')
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf).cast('B')
+        self.hdr = self._decode(Tmf8820_msg_header)
+
+    def _decode(self, cls):
+        if len(self.buf) >= ctypes.sizeof(cls):
+            return cls.from_buffer_copy(self.buf)
+        # truncated message, missing fields read as 0 like in Tmf8820_msg
+        obj = cls()
+        memoryview(obj).cast('B')[:len(self.buf)] = self.buf
+        return obj
+
+    @property
+    def err_msg(self):
+        return self._decode(Tmf8820_msg_error)
+
+    @property
+    def meas_stat_msg(self):
+        return self._decode(Tmf8820_msg_meas_stats)
+
+    @property
+    def hist_msg(self):
+        return self._decode(Tmf8820_msg_histogram_header)
+
+    @property
+    def meas_result_msg(self):
+        return self._decode(Tmf8820_msg_meas_results_header)
+
+    @property
+    def hist_bins(self):
+        # uint32 array of shape (num_tdc, MAX_BINS), channel a in [:, :128], b in [:, 128:]
+        num_tdc = min(max(self._field(Tmf8820_msg_histogram.num_tdc), 0), MAX_TDC)
+        return self._array(HISTOGRAM_BINS_OFFSET, np.uint32, num_tdc * MAX_BINS).reshape(num_tdc, MAX_BINS)
+
+    @property
+    def meas_results(self):
+        # structured array of the valid results, fields as in Tmf8820_meas_result
+        valid = min(max(self._field(Tmf8820_msg_meas_results.valid_results), 0), MAX_NUM_RESULTS)
+        return self._array(MEAS_RESULTS_OFFSET, MEAS_RESULT_DTYPE, valid)
+
+    def _field(self, field):
+        # single int field of a message, field is the ctypes descriptor e.g. Tmf8820_msg_histogram.num_tdc
+        if field.offset + field.size > len(self.buf):
+            return 0
+        return ctypes.c_int.from_buffer_copy(self.buf, field.offset).value
+
+    def _array(self, offset, dtype, count):
+        dtype = np.dtype(dtype)
+        if offset + count * dtype.itemsize <= len(self.buf):
+            return np.frombuffer(self.buf, dtype=dtype, count=count, offset=offset)
+        arr = np.zeros(count, dtype=dtype)
+        data = self.buf[offset:offset + count * dtype.itemsize]
+        arr.view(np.uint8)[:len(data)] = data
+        return arr
+
 
 # pixel positions
 #  1  2  3  4  5  6  7  8
@@ -140,17 +238,31 @@ pixelMap = {
     71 : 52, 72 : 56, 73 : 36, 74 : 40, 75 : 20, 76 : 24, 77 : 4 ,78 : 8 
 }
 
+HISTOGRAMS_IN_8X8_MODE = NUMBER_OF_CAPTURES_IN_8X8_MODE * HISTOGRAMS_PER_CAPTURE_IN_8X8
+
+# histogram numbers of the 64 pixels in pixel order (pixel 1 first), derived from pixelMap
+PIXEL_HISTOGRAM_NUMBERS = np.array(sorted(pixelMap, key=pixelMap.get), dtype=np.intp)
+# histogram numbers of the reference channels, the first channel of every sub-capture
+REF_HISTOGRAM_NUMBERS   = np.arange(0, HISTOGRAMS_IN_8X8_MODE, HISTOGRAMS_PER_SUBCAPTURE)
+# True for the histogram numbers of pixels, False for reference and unused channels
+PIXEL_MASK              = np.isin(np.arange(HISTOGRAMS_IN_8X8_MODE), PIXEL_HISTOGRAM_NUMBERS)
+PIXEL_CHANNELS          = tuple(int(x) for x in np.flatnonzero(PIXEL_MASK))
+
+# spad_ch (1 to 64) -> zone (1 to 64 in 8x8 order)
+spad_ch_2_zone = [   0,   # unused
+    39, 47, 55, 63, 40, 48, 56, 64, 7, 15, 23, 
+    31, 8, 16, 24, 32, 37, 45, 53, 61, 38, 46, 
+    54, 62, 5, 13, 21, 29, 6, 14, 22, 30, 35,
+    43, 51, 59, 36, 44, 52, 60, 3, 11, 19, 27,
+    4, 12, 20, 28, 33, 41, 49, 57, 34, 42, 50, 
+    58, 1, 9, 17, 25, 2, 10, 18, 26]       # spad_ch is 1 to 64
+
+# deprecated: added to every res_num like res_num_offset (see Capture8x8Session),
+# kept for scripts that set it. Use res_num_offset instead.
 fudge_res_num = 0
-def calc_zn(res_num, sub_capture, ch):
-    global fudge_res_num
-    spad_ch_2_zone = [   0,   # unused
-        39, 47, 55, 63, 40, 48, 56, 64, 7, 15, 23, 
-        31, 8, 16, 24, 32, 37, 45, 53, 61, 38, 46, 
-        54, 62, 5, 13, 21, 29, 6, 14, 22, 30, 35,
-        43, 51, 59, 36, 44, 52, 60, 3, 11, 19, 27,
-        4, 12, 20, 28, 33, 41, 49, 57, 34, 42, 50, 
-        58, 1, 9, 17, 25, 2, 10, 18, 26]       # spad_ch is 1 to 64
-    seq_step = (res_num + fudge_res_num) % 4   # one time-multiplexed result (2 captures)
+
+def calc_zn(res_num, sub_capture, ch, res_num_offset=0):
+    seq_step = (res_num + res_num_offset + fudge_res_num) % 4   # one time-multiplexed result (2 captures)
     spad_ch = ch + 8*sub_capture
     spad_ch += seq_step*16
 
@@ -169,43 +281,69 @@ zn_2_obj_pix = [ 0 ]   + \
     list(range(55,63)) + \
     list(range(64,72))
 
-def calc_obj_pix(res_num, sub_capture, ch):
-    zn = calc_zn(res_num, sub_capture, ch)
+def calc_obj_pix(res_num, sub_capture, ch, res_num_offset=0):
+    zn = calc_zn(res_num, sub_capture, ch, res_num_offset)
     return zn_2_obj_pix[zn]
 
-logfile_obj_accum = list()    # indexing starts at 0 with pixel 1 object 0, pixel 1 object 1...
+OBJ_PIXELS = 72
+OBJ_PER_PIXEL = 2           # ch_target_idx 0 and 1
+RESULT_CHANNELS = 10        # result channel numbers 0 to 9, 1 to 8 are zones
+
+# (seq_step, sub_capture, channel) -> obj_pix - 1, -1 for channels without a zone
+def _objIndexLut():
+    lut = np.full((NUMBER_OF_CAPTURES_IN_8X8_MODE, 2, RESULT_CHANNELS), -1, dtype=np.intp)
+    for seq_step in range(NUMBER_OF_CAPTURES_IN_8X8_MODE):
+        for sub_capture in range(2):
+            for ch in range(1, 9):
+                lut[seq_step, sub_capture, ch] = calc_obj_pix(seq_step, sub_capture, ch, -fudge_res_num) - 1
+    return lut
+
+OBJ_INDEX_LUT = _objIndexLut()
+
+# #OBJ entries: structured array (72, 2) of Tmf8820_meas_result, [obj_pix - 1][ch_target_idx]
+def newObjEntries():
+    return np.zeros((OBJ_PIXELS, OBJ_PER_PIXEL), dtype=MEAS_RESULT_DTYPE)
+
+# setObjEntries( obj, res_num, results )
+# stores all results of one result message (the meas_results of a Tmf8820_msg_view)
+# in the #OBJ entries obj, results of channels without a zone are ignored
+def setObjEntries( obj, res_num, results, res_num_offset=0 ):
+    ch  = results['channel']
+    sub = results['sub_capture']
+    idx = results['ch_target_idx']
+    valid = ( ch >= 0 ) & ( ch < RESULT_CHANNELS ) & ( sub >= 0 ) & ( sub < 2 ) & ( idx >= 0 ) & ( idx < OBJ_PER_PIXEL )
+    if not valid.all():
+        results, ch, sub, idx = results[valid], ch[valid], sub[valid], idx[valid]
+    opix = OBJ_INDEX_LUT[( res_num + res_num_offset + fudge_res_num ) % NUMBER_OF_CAPTURES_IN_8X8_MODE, sub, ch]
+    zone = opix >= 0
+    obj[opix[zone], idx[zone]] = results[zone]
+
+# distance / confidence of the #OBJ entries as (8, 8, 2) views in pixel order,
+# [row][col][ch_target_idx] belongs to pixel row*8+col+1 (the obj_pix columns 9, 18 .. 72 are skipped)
+def objDistanceMap( obj ):
+    return obj['distance_mm'].reshape(8, 9, OBJ_PER_PIXEL)[:, :8]
+
+def objConfidenceMap( obj ):
+    return obj['confidence'].reshape(8, 9, OBJ_PER_PIXEL)[:, :8]
+
+# session-free #OBJ entries for scripts using the module level functions:
+# newObjEntries() flattened, indexing starts at 0 with pixel 1 object 0, pixel 1
+# object 1..., its records have attributes (logfile_obj_accum[i].distance_mm).
+# getAllHistogramsIn8x8Mode leaves the entries of its frame in it, the capture
+# sessions keep their own entries and do not change it.
+logfile_obj_accum = newObjEntries().reshape(-1).view(np.recarray)
 
 def clear_obj_entries():
-    global logfile_obj_accum
-    logfile_obj_accum = list()
-    for x in range(72):
-        logfile_obj_accum.append(Tmf8820_meas_result())    # object 0
-        logfile_obj_accum[x*2].confidence      = 0
-        logfile_obj_accum[x*2].distance_mm     = 0
-        logfile_obj_accum[x*2].channel         = 0
-        logfile_obj_accum[x*2].ch_target_idx   = 0
-        logfile_obj_accum[x*2].sub_capture     = 0
-        logfile_obj_accum.append(Tmf8820_meas_result())    # object 1
-        logfile_obj_accum[x*2+1].confidence    = 0
-        logfile_obj_accum[x*2+1].distance_mm   = 0
-        logfile_obj_accum[x*2+1].channel       = 0
-        logfile_obj_accum[x*2+1].ch_target_idx = 0
-        logfile_obj_accum[x*2+1].sub_capture   = 0
-
-clear_obj_entries()
+    logfile_obj_accum[...] = 0
 
 def set_obj_entry(res_num, sub_capture, ch, ch_target_idx, distance, confidence):
-    global logfile_obj_accum
-    # ch_target_idx is object 0 or 1
-    obji = (calc_obj_pix(res_num, sub_capture, ch) - 1) * 2 + ch_target_idx
-    # print(f"obji {obji}")
-
-    # add to global structure that will be the #OBJ log file pixel data
-    logfile_obj_accum[obji].confidence    = confidence
-    logfile_obj_accum[obji].distance_mm   = distance
-    logfile_obj_accum[obji].channel       = ch
-    logfile_obj_accum[obji].ch_target_idx = ch_target_idx
-    logfile_obj_accum[obji].sub_capture   = sub_capture
+    result = np.zeros(1, dtype=MEAS_RESULT_DTYPE)
+    result['sub_capture']   = sub_capture
+    result['channel']       = ch
+    result['ch_target_idx'] = ch_target_idx
+    result['distance_mm']   = distance
+    result['confidence']    = confidence
+    setObjEntries(logfile_obj_accum.reshape(OBJ_PIXELS, OBJ_PER_PIXEL), res_num, result)
 
 def mapHistogramNumber( histogram, numbers=False ):
     if numbers:
@@ -218,268 +356,1067 @@ def mapHistogramNumber( histogram, numbers=False ):
             return f"{pixelMap[histogram]:02}"
         else:
             return ""
- 
-def connectToRaspi( ):
-    ctx = zmq.Context()
+
+# copy all channel histograms of one histogram message into channels, an
+# array of shape (80, 128) indexed by histogram number (see pixelMap)
+def addHistogramsToChannels( channels, hist, bins ):
+    if hist.sub_capture not in (0, 1):
+        return
+    first = ( hist.capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE ) * HISTOGRAMS_PER_CAPTURE_IN_8X8 + hist.sub_capture * HISTOGRAMS_PER_SUBCAPTURE
+    # (num_tdc, 256) -> (2 * num_tdc, 128): rows are channel a, b of tdc 0, a, b of tdc 1, ...
+    rows = bins.reshape(-1, BINS_PER_TDC_CHANNEL)[:HISTOGRAMS_PER_SUBCAPTURE]
+    channels[first:first + len(rows)] = rows
+
+# reorder the 80 channel histograms into an (8, 8, 128) pixel frame and the
+# (8, 128) reference channel histograms, histograms / ref_histograms are reused if given
+def channelsToFrame8x8( channels, histograms=None, ref_histograms=None ):
+    if histograms is None:
+        histograms = np.empty((8, 8, BINS_PER_TDC_CHANNEL), dtype=np.uint32)
+    if ref_histograms is None:
+        ref_histograms = np.empty((len(REF_HISTOGRAM_NUMBERS), BINS_PER_TDC_CHANNEL), dtype=np.uint32)
+    np.take(channels, PIXEL_HISTOGRAM_NUMBERS, axis=0, out=histograms.reshape(64, BINS_PER_TDC_CHANNEL))
+    np.take(channels, REF_HISTOGRAM_NUMBERS, axis=0, out=ref_histograms)
+    return histograms, ref_histograms
+
+# line starts of the #HIST lines by histogram number
+HIST_LABELS_8X8 = [f"#HIST{mapHistogramNumber(n)}" for n in range(HISTOGRAMS_IN_8X8_MODE)]   # pixel number
+HIST_LABELS_4X4 = [f"#HIST{n}" for n in range(HISTOGRAMS_IN_8X8_MODE)]                        # histogram number
+
+# HistogramLogWriter( file, labels=HIST_LABELS_8X8 )
+# writes the EVM GUI log format (#HISTINFO, #HIST and #OBJ lines) to the text
+# file object file, message by message. All lines of a histogram message are
+# formatted with one precomputed format string instead of per bin.
+
+class HistogramLogWriter:
+    def __init__(self, file, labels=HIST_LABELS_8X8):
+        self.file = file
+        self.labels = labels
+        self.formats = dict()     # (first histogram number, number of rows) -> format of the #HIST lines
+
+    def _format(self, first, count):
+        key = (first, count)
+        fmt = self.formats.get(key)
+        if fmt is None:
+            labels = [self.labels[n] if n < len(self.labels) else f"#HIST{n}" for n in range(first, first + count)]
+            fmt = "".join(label + ";%d" * BINS_PER_TDC_CHANNEL + "\n" for label in labels)
+            self.formats[key] = fmt
+        return fmt
+
+    # one histogram message: hist has the header fields (Tmf8820_msg_histogram_header),
+    # rows are its (2 * num_tdc, 128) channel histograms, first the histogram number of rows[0]
+    def writeHistograms(self, hist, rows, first):
+        self.writeHistogramsInfo(hist.capture_num, hist.histogram_type, hist.num_tdc, hist.num_bins, hist.sub_capture, rows, first)
+
+    def writeHistogramsInfo(self, capture_num, histogram_type, num_tdc, num_bins, sub_capture, rows, first):
+        self.file.write(f"#HISTINFO;Transaction ID: {capture_num};Capture: {capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE};Type: {histogram_type};num_tdc: {num_tdc};num_bins: {num_bins};sub_capture: {sub_capture}\n")
+        self.file.write(self._format(first, len(rows)) % tuple(rows.ravel().tolist()))
+
+    # the #OBJ line, obj are the #OBJ entries (see newObjEntries)
+    def writeObj(self, obj, rows=8, cols=8):
+        obj = obj.reshape(-1)
+        values = np.empty((len(obj), 2), dtype=np.int64)
+        values[:, 0] = obj['distance_mm']
+        values[:, 1] = obj['confidence']
+        fmt = self.formats.get(('#OBJ', len(obj), rows, cols))
+        if fmt is None:
+            fmt = f"#OBJ;12345678;0;{rows};{cols}" + ";%d;%d" * len(obj) + "\n"
+            self.formats[('#OBJ', len(obj), rows, cols)] = fmt
+        self.file.write(fmt % tuple(values.ravel().tolist()))
+
+    # a complete sequence (Tmf8828_frame or Tmf8828_frame4x4), same text as
+    # getAllHistogramsIn8x8Mode / getAllHistogramsIn4x4Mode log for it
+    def writeFrame(self, frame):
+        for slot, (capture_num, histogram_type, num_tdc, num_bins) in enumerate(frame.hist_info.tolist()):
+            if num_bins == 0:       # no histogram message for this slot (3x3 mode has 1 sub-capture only)
+                continue
+            first = slot * HISTOGRAMS_PER_SUBCAPTURE
+            rows = frame.channels[first:first + min(num_tdc, MAX_TDC) * NUMBER_OF_TDC_CHANNELS]
+            self.writeHistogramsInfo(capture_num, histogram_type, num_tdc, num_bins, slot % 2, rows, first)
+        if frame.obj is not None:
+            self.writeObj(frame.obj, *frame.obj_shape)
+
+# connectToRaspi( uri=ZMQ_URI, ctx=None, rcvhwm=None )
+# rcvhwm limits the messages zmq queues for the socket (zmq default 1000), a
+# smaller queue holds less stale data to drain before a capture. Beyond it zmq
+# drops whole messages, which the capture sessions detect as missed captures.
+# zmq.CONFLATE is no option: it keeps only the last message, but a frame is
+# made of many messages.
+
+def connectToRaspi( uri=ZMQ_URI, ctx=None, rcvhwm=None ):
+    if ctx is None:
+        ctx = zmq.Context()
     sub = ctx.socket(zmq.SUB)
+    if rcvhwm is not None:
+        sub.setsockopt(zmq.RCVHWM, rcvhwm)
     sub.setsockopt(zmq.SUBSCRIBE, b"")
-    sub.connect(ZMQ_URI)
+    sub.connect(uri)
     return sub
 
+# same as connectToRaspi but the socket is a zmq.asyncio socket, recv() must be awaited
+def connectToRaspiAsync( uri=ZMQ_URI, ctx=None, rcvhwm=None ):
+    if ctx is None:
+        ctx = zmq.asyncio.Context.instance()
+    return connectToRaspi(uri, ctx, rcvhwm)
 
-# getAllHistogramsIn8x8Mode( sub, do_function=None)
-# the function "do_function" has input of 1 histogram, and outputs anything
+# drainMessages( sub )
+# discards the messages already queued on the zmq socket sub without waiting for
+# more, returns their number. Other message sources are left untouched.
 
-def getAllHistogramsIn8x8Mode( sub, do_function=None):
-    global logfile_obj_accum
+def drainMessages( sub ):
+    drained = 0
+    if hasattr(sub, "recv"):
+        try:
+            while True:
+                sub.recv(zmq.NOBLOCK, copy=False)
+                drained += 1
+        except zmq.Again:
+            pass
+    return drained
 
-    logString = ""
 
-    # initialize a results structure -- will be filled as results are received
-    clear_obj_entries()
+# TofDeviceReader reads the message stream of the driver char device directly,
+# without the zmq bridge of the EVM. Any file or FIFO holding the same stream
+# works as well. Each read() returns as many complete messages as fit into the
+# (reused) read buffer, iterating the reader splits them in place and yields a
+# Tmf8820_msg_view per message.
+# The views point into the read buffer: they are only valid until the next
+# message is requested. Iteration ends at end of file, or when no data arrived
+# for timeout_ms (None waits forever). Messages left in the buffer when an
+# iteration is abandoned (e.g. by a capture) are yielded first by the next one.
+# A read error or an invalid message length ends every iteration, error is
+# then set to its "#ERROR;..." text (see ReadError).
+# poll() waits for data, the reads themselves block by default: the driver
+# then waits for its lock instead of failing the read. A read may wait beyond
+# timeout_ms if another reader took the data after poll(). With blocking=False
+# a read without data (EAGAIN, or ENODATA from the driver) goes back to poll().
+#
+#   with TofDeviceReader() as tof:
+#       for frame in stream_8x8_frames(tof):
+#           ...
 
-    # do not log until the first capture of a sequence is found
-    logging = False
+class TofDeviceReader:
+    def __init__(self, path=TOF_DEVICE, read_size=32 * MAX_MSG_SIZE, timeout_ms=None, blocking=True):
+        # opening a FIFO without O_NONBLOCK would wait for its writer
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(self.fd, blocking)
+        self.buf = bytearray(read_size)
+        self.fill = 0            # bytes in buf
+        self.offset = 0          # start of the next message in buf
+        self.timeout_ms = timeout_ms
+        self.error = None
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
 
-    # flags for detecting if we are getting the correct messages
-    numberOfNonHistogramMessages = 0
-    lastSubCapture = -1
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
-    functions_val = dict()
+    def __enter__(self):
+        return self
 
-    preflush = 0      # count of histograms read in for purposes of flushing the input buffer
-    while True:
-        msg = Tmf8820_msg(sub.recv())
-
-        # Histogram message
-        if msg.hdr.id == HISTOGRAM_ID_MEASUREMENT:
-            
-            numberOfNonHistogramMessages = 0
-            if msg.hist_msg.sub_capture == 1:
-                lastSubCapture = 1
-
-            preflush += 1
-            if preflush > 10:
-                hist = msg.hist_msg
-    
-                if ( lastSubCapture < 1):
-                    logstr = "#ERROR;Time multiplexed measurement not enabled. Exiting."
-                    print(logstr)
-                    return logstr
-                else:
-                    #lastSubCapture = hist.sub_capture
-                    pass
-    
-                isFirstCapture = (hist.capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE == 0) and ( hist.sub_capture == 0 )
-    
-                # if isFirstCapture:
-                #     print(f"HISTOGRAM_ID_MEASUREMENT preflush {preflush} isFirstCapture")
-                # else:
-                #     print(f"HISTOGRAM_ID_MEASUREMENT preflush {preflush}")
-                # did we capture and log a complete sequence?
-                if ( logging and isFirstCapture ):
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        buf = memoryview(self.buf)
+        while self.error is None:
+            while self.fill - self.offset >= ctypes.sizeof(Tmf8820_msg_header):
+                offset = self.offset
+                length = Tmf8820_msg_header.from_buffer(self.buf, offset).len
+                if length < ctypes.sizeof(Tmf8820_msg_header) or length > len(self.buf):
+                    self.error = f"#ERROR;Invalid message length {length}. Exiting."
+                    return
+                if offset + length > self.fill:
                     break
-    
-                # did we find the first capture in a new sequence?
-                if ( ( not logging ) and isFirstCapture):
-                    logging = True
-    
-                if logging:
-                    logString += f"#HISTINFO;Transaction ID: {hist.capture_num};Capture: {hist.capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE};Type: {hist.histogram_type};num_tdc: {hist.num_tdc};num_bins: {hist.num_bins};sub_capture: {hist.sub_capture}\n"
-    
-                    for tdc in range(0,hist.num_tdc):
-                        currentHistogram = ( hist.capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE) * HISTOGRAMS_PER_CAPTURE_IN_8X8 + hist.sub_capture*HISTOGRAMS_PER_SUBCAPTURE + tdc*NUMBER_OF_TDC_CHANNELS
-    
-                        histogram_a = hist.bins[tdc][:BINS_PER_TDC_CHANNEL]
-                        histogram_b = hist.bins[tdc][BINS_PER_TDC_CHANNEL:]
+                # consumed before it is yielded: an abandoned iteration keeps the rest
+                self.offset = offset + length
+                yield Tmf8820_msg_view(buf[offset:self.offset])
+            # move the partial message to the start of the buffer
+            self.buf[:self.fill - self.offset] = self.buf[self.offset:self.fill]
+            self.fill -= self.offset
+            self.offset = 0
 
-                        if do_function:            # a function was specified (it wasn't None)
-                            functions_val.update({currentHistogram+0: do_function(histogram_a)})
-                            functions_val.update({currentHistogram+1: do_function(histogram_b)})
+            if not self.poller.poll(self.timeout_ms):
+                return
+            try:
+                size = os.readv(self.fd, [buf[self.fill:]])
+            except OSError as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENODATA):
+                    continue
+                self.error = f"#ERROR;Read failed: {error.strerror}. Exiting."
+                return
+            if size == 0:
+                return
+            self.fill += size
 
-                        binString = ""
-    
-                        for binValue in hist.bins[tdc][:BINS_PER_TDC_CHANNEL]:
-                            binString += f";{binValue}"
-    
-                        logString += f"#HIST{mapHistogramNumber(currentHistogram+0)}{binString}\n"
-    
-                        binString = ""
-    
-                        for binValue in hist.bins[tdc][BINS_PER_TDC_CHANNEL:]:
-                            binString += f";{binValue}"
-    
-                        logString += f"#HIST{mapHistogramNumber(currentHistogram+1)}{binString}\n"
-            else:        # preflush < n
-                pass
-        elif msg.hdr.id == 1:
-            if preflush > 10:   # TBD in order to get exact correlation w/histograms
-                res = msg.meas_result_msg
-                for r in range(res.valid_results):
-                    # print("OBJ data res_num: {} num_res: {} ch: {} sub_capture: {} ch_target_idx: {} distance: {}".format(res.result_num,
-                    #     res.num_results,
-                    #     res.results[r].channel,
-                    #     res.results[r].sub_capture,
-                    #     res.results[r].ch_target_idx,
-                    #     res.results[r].distance_mm))
-                    # add to logfile_obj_accum[]
-                    set_obj_entry(
-                        res.result_num,
-                        res.results[r].sub_capture,
-                        res.results[r].channel,
-                        res.results[r].ch_target_idx,
-                        res.results[r].distance_mm,
-                        res.results[r].confidence)
+# CaptureStats collects timing and counters of a capture pipeline. It is opt-in:
+# pass it to a session (Capture8x8Session(stats=CaptureStats())) and everything
+# driven by that session records into it, without it nothing is measured.
+# Stages are timed with perf_counter_ns:
+#   receive   waiting for the next message
+#   decode    Tmf8820_msg_view of a received buffer
+#   assemble  session.feed()
+#   format    log text of a frame
+#   callback  do_function of all histograms of a frame
+# One CaptureStats can be shared by several sessions in the same thread. Other
+# threads (e.g. the worker of an AnalysisStage) may record into it as well:
+# add(), queueDepth() and summary() hold its lock.
+# With report_interval_s a summary() is written to file that often, checked
+# whenever a frame completes.
+
+class CaptureStats:
+    def __init__(self, report_interval_s=None, file=None):
+        self.report_interval_s = report_interval_s
+        self.file = file
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started_ns  = time.perf_counter_ns()
+        self.reported_ns = self.started_ns
+        self.stage_ns    = collections.defaultdict(int)    # stage -> total time
+        self.stage_max_ns = collections.defaultdict(int)
+        self.stage_count = collections.defaultdict(int)
+        self.messages    = collections.Counter()            # hdr.id -> received messages
+        self.non_histogram_messages = 0
+        self.queue_depth = dict()                           # queue name -> (current, maximum) depth
+
+    def add(self, stage, ns):
+        with self.lock:
+            self.stage_ns[stage] += ns
+            self.stage_count[stage] += 1
+            if ns > self.stage_max_ns[stage]:
+                self.stage_max_ns[stage] = ns
+
+    def queueDepth(self, name, depth):
+        with self.lock:
+            maximum = self.queue_depth.get(name, (0, 0))[1]
+            self.queue_depth[name] = (depth, max(depth, maximum))
+
+    # called by the sessions for every completed frame
+    def frameDone(self, session):
+        if self.report_interval_s is None:
+            return
+        now = time.perf_counter_ns()
+        if now - self.reported_ns >= self.report_interval_s * 1e9:
+            self.reported_ns = now
+            print(self.summary(session), file=self.file or sys.stdout)
+
+    # summary( session=None )
+    # one "#STATS;..." line per stage, message id and queue, with the frame
+    # counters of session if given
+    def summary(self, session=None):
+        elapsed_s = max(time.perf_counter_ns() - self.started_ns, 1) / 1e9
+        lines = []
+        if session is not None:
+            lines.append(f"#STATS;frames: {session.frames};frames/s: {session.frames / elapsed_s:.1f};"
+                         f"frames_dropped: {session.frames_dropped};captures_missed: {session.captures_missed};"
+                         f"out_of_order: {session.out_of_order};device_errors: {session.device_errors};"
+                         f"stalls: {session.stalls};resyncs: {session.resyncs}")
+        with self.lock:
+            for stage, total in self.stage_ns.items():
+                count = self.stage_count[stage]
+                lines.append(f"#STATS;stage: {stage};count: {count};mean_us: {total / count / 1e3:.1f};"
+                             f"max_us: {self.stage_max_ns[stage] / 1e3:.1f};total_s: {total / 1e9:.3f}")
+            for msg_id, count in sorted(self.messages.items()):
+                lines.append(f"#STATS;id: {msg_id};messages: {count};messages/s: {count / elapsed_s:.1f}")
+            lines.append(f"#STATS;non_histogram_messages: {self.non_histogram_messages}")
+            for name, (depth, maximum) in self.queue_depth.items():
+                lines.append(f"#STATS;queue: {name};depth: {depth};max_depth: {maximum}")
+        return "\n".join(lines)
+
+
+# receiveMessages( sub, stats=None )
+# yields a Tmf8820_msg_view for every message of sub, which is either a zmq
+# socket or an iterable of Tmf8820_msg_view (TofDeviceReader).
+# With a CaptureStats the receive and decode times are recorded.
+
+def receiveMessages( sub, stats=None ):
+    if stats is not None:
+        yield from _receiveMessagesTimed(sub, stats)
+    elif hasattr(sub, "recv"):
+        while True:
+            yield Tmf8820_msg_view(sub.recv(copy=False))
+    else:
+        yield from sub
+
+def _receiveMessagesTimed( sub, stats ):
+    clock = time.perf_counter_ns
+    if hasattr(sub, "recv"):
+        while True:
+            t0 = clock()
+            yield _decodeTimed(sub.recv(copy=False), stats, t0)
+    else:
+        # the source decodes while it is read
+        messages = iter(sub)
+        while True:
+            t0 = clock()
+            msg = next(messages, None)
+            if msg is None:
+                return
+            stats.add('receive', clock() - t0)
+            yield msg
+
+# Tmf8820_msg_view of data received since t0, both recorded in stats
+def _decodeTimed( data, stats, t0 ):
+    t1 = time.perf_counter_ns()
+    msg = Tmf8820_msg_view(data)
+    stats.add('receive', t1 - t0)
+    stats.add('decode', time.perf_counter_ns() - t1)
+    return msg
+
+# receiveMessagesAsync( sub, stats=None )
+# asyncio version of receiveMessages for a zmq.asyncio socket
+
+async def receiveMessagesAsync( sub, stats=None ):
+    clock = time.perf_counter_ns
+    while True:
+        if stats is None:
+            yield Tmf8820_msg_view(await sub.recv(copy=False))
         else:
-            # prevent endless loops if histogram dumping is not enabled
-            numberOfNonHistogramMessages += 1
-            if ( numberOfNonHistogramMessages > MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES ):
-                logstr = "#ERROR;Histogram dumping not enabled. Exiting." 
-                print(logstr)
-                return logstr
-        # error message, exit immediately
-        if msg.hdr.id == ERROR_ID:
-            err = msg.err_msg
-            logstr = f"#ERROR;CODE: {err.error_code}\n"
-            print(logstr)
-            return logstr
-
-    logString += f"#OBJ;12345678;0;8;8"
-    for opix in range(1,73):
-        confidence = logfile_obj_accum[(opix - 1)*2 + 0].confidence
-        distance   = logfile_obj_accum[(opix - 1)*2 + 0].distance_mm
-        logString += f";{distance};{confidence}"
-        confidence = logfile_obj_accum[(opix - 1)*2 + 1].confidence
-        distance   = logfile_obj_accum[(opix - 1)*2 + 1].distance_mm
-        logString += f";{distance};{confidence}"
-    logString += f"\n"
+            t0 = clock()
+            yield _decodeTimed(await sub.recv(copy=False), stats, t0)
+
+
+Capture8x8Result = collections.namedtuple('Capture8x8Result', ['log', 'values', 'frame'])
 
+# captureHistograms8x8( sub, do_function=None, session=None )
+# captures one 8x8 sequence and returns a Capture8x8Result: the log text, the
+# do_function values of the 80 histograms (None without do_function) and the
+# Tmf8828_frame. Raises the CaptureError that ended the capture.
+
+def captureHistograms8x8( sub, do_function=None, session=None ):
+    if session is None:
+        session = Capture8x8Session()
+
+    # the messages queued so far are discarded for purposes of flushing the input buffer
+    frame = session.capture(sub)
+    if frame is None:
+        raise session.exception
+
+    clock = time.perf_counter_ns
+    t0 = clock()
+    log = HistogramLogWriter(io.StringIO(), HIST_LABELS_8X8)
+    log.writeFrame(frame)
+    logString = log.file.getvalue()
+    if session.stats is not None:
+        session.stats.add('format', clock() - t0)
+
+    functions_val = None
+    if do_function:            # a function was specified (it wasn't None)
+        t0 = clock()
+        functions_val = {histogram: do_function(bins) for histogram, bins in enumerate(frame.channels.tolist())}
+        if session.stats is not None:
+            session.stats.add('callback', clock() - t0)
+    return Capture8x8Result(logString, functions_val, frame)
+
+# getAllHistogramsIn8x8Mode( sub, do_function=None, session=None )
+# the function "do_function" has input of 1 histogram, and outputs anything
+# pass a Capture8x8Session(reuse_frames=True) to reuse its buffers across calls
+# returns the log text, with do_function the log text and the values, on
+# errors the "#ERROR;..." text
+
+def getAllHistogramsIn8x8Mode( sub, do_function=None, session=None ):
+    try:
+        result = captureHistograms8x8(sub, do_function, session)
+    except CaptureError as error:
+        print(error)
+        return str(error)
+
+    logfile_obj_accum[...] = result.frame.obj.reshape(-1)
     if do_function:
-        return logString, functions_val
+        return result.log, result.values
     else:
-        return logString
+        return result.log
 
 
-# TBD this needs the #OBJ addition like the 8x8 capture above
+# getHistogramFrameIn8x8Mode( sub, histograms=None, ref_histograms=None, session=None )
+# captures one complete 8x8 sequence like getAllHistogramsIn8x8Mode but returns
+# the histograms as arrays instead of log text:
+#   histograms     uint32 (8, 8, 128), histograms[row][col] is pixel row*8+col+1
+#   ref_histograms uint32 (8, 128), reference channel of capture c, sub-capture s at [c*2+s]
+# pass preallocated arrays to have them filled in place. Raises a CaptureError
+# if no sequence could be captured.
 
-def getAllHistogramsIn4x4Mode( sub, returnzones=[]):
-    
-    logString = ""
-    hlist = []
+def getHistogramFrameIn8x8Mode( sub, histograms=None, ref_histograms=None, session=None ):
+    if session is None:
+        session = Capture8x8Session()
 
-    # do not log until the first capture of a sequence is found
-    logging = False
+    frame = session.capture(sub)
+    if frame is None:
+        raise session.exception
 
-    # flags for detecting if we are getting the correct messages
-    messagesSinceHistogram = 0
-    lastSubCapture = -1
+    return channelsToFrame8x8(frame.channels, histograms, ref_histograms)
 
-    preflush = 0      # count of histograms read in for purposes of flushing the input buffer
-    while True:
-        msg = Tmf8820_msg(sub.recv())
-        messagesSinceHistogram += 1
-
-        # Result message
-        if msg.hdr.id == 1:
-            res = msg.meas_result_msg
-            # print("results res_num: {}\tnum_res: {}".format(res.result_num,
-            #                                                 res.num_results))
-            # for r in range(res.valid_results):
-            #     print("ch: {} sub_capture: {} ch_target_idx: {} distance: {}".format(res.results[r].channel,
-            #                                                                      res.results[r].sub_capture,
-            #                                                                      res.results[r].ch_target_idx,
-            #                                                                      res.results[r].distance_mm))
-
-        # Stats message
-        elif msg.hdr.id == 2:
-            stats = msg.meas_stat_msg
-            # print("stats capture_num: {} acc hits: {}".format(stats.capture_num,
-            #                                                   stats.accumulated_hits))
-
-
-        # Histogram message
-        # "histogram_type" excludes some extraneous histograms (electrical cal?)
-        elif msg.hdr.id == HISTOGRAM_ID_MEASUREMENT:       #  and msg.hist_msg.histogram_type != 0:
-    
-            hist = msg.hist_msg
-            messagesSinceHistogram = 0
-
-            preflush += 1
-            if preflush > 40:
-                # print("histogram message type: {}".format(hist.histogram_type))
-                if hist.histogram_type == 1:   #  or hist.num_bins == 256:
-                    for x in range(hist.num_tdc):
-                        pass
-                        # print("Electrical Calibration TDC[{}] max val: {}".format(x, max(hist.bins[x])))
+
+# Errors of a capture. str() of an error is the "#ERROR;..." text that the
+# capture functions print and return. Recoverable errors only end a capture
+# when the session does not recover (see CaptureSession).
+
+class CaptureError(Exception):
+    recoverable = False
+
+# ERROR_ID message of the device
+class DeviceError(CaptureError):
+    recoverable = True
+
+    def __init__(self, error_code):
+        super().__init__(f"#ERROR;CODE: {error_code}\n")
+        self.error_code = error_code
+
+# MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES messages in a row without a histogram
+class HistogramDumpingError(CaptureError):
+    recoverable = True
+
+    def __init__(self):
+        super().__init__("#ERROR;Histogram dumping not enabled. Exiting.")
+
+# complete sequences without sub-capture 1
+class TimeMultiplexingError(CaptureError):
+    def __init__(self):
+        super().__init__("#ERROR;Time multiplexed measurement not enabled. Exiting.")
+
+class EndOfStreamError(CaptureError):
+    def __init__(self):
+        super().__init__("#ERROR;End of message stream. Exiting.")
+
+# the message source failed, message is its error text (see TofDeviceReader)
+class ReadError(CaptureError):
+    pass
+
+
+# CaptureSession is the frame state machine shared by Capture8x8Session and
+# Capture4x4Session. A frame is captures_per_frame consecutive captures of up to
+# 2 sub-captures each and starts with sub-capture 0 of a capture_num divisible
+# by captures_per_frame. The histogram message of capture c, sub-capture s of
+# the frame goes to slot c*2+s: frame.hist_info[slot], frame.stats[slot] and the
+# channel histograms from slot * HISTOGRAMS_PER_SUBCAPTURE on. Results and
+# statistics are attached to the frame of their capture_num. The subclasses
+# define the frame class and when a frame is complete.
+#
+# A gap in capture_num discards the frame being assembled, it is counted in
+# frames_dropped together with frames that were skipped entirely.
+#
+# Errors: with recover (the default) a recoverable error discards the frame
+# being assembled and the session locks on to the next frame start, the capture
+# goes on. It is counted in device_errors (ERROR_ID messages) or stalls (too
+# many messages without histograms). After max_recoveries recoveries without
+# a complete frame in between, or on any other error, the capture ends:
+# exception is set to the CaptureError and error to its text. By default
+# (max_recoveries None) capture() gives up after MAX_RECOVERIES_WITHOUT_FRAME
+# recoveries, feed() and the streams never do.
+# resyncs counts the restarts of the frame assembly after recovered errors and
+# capture_num discontinuities.
+
+class CaptureSession:
+    __slots__ = ('reuse_frames', 'recover', 'frame', 'spare', 'returned', 'received', 'last_capture_num',
+                 'next_capture_num', 'pending_stats', 'non_histogram_messages', 'frames', 'frames_dropped',
+                 'captures_missed', 'out_of_order', 'device_errors', 'stalls', 'resyncs', 'recoveries',
+                 'max_recoveries', 'recovery_limit', 'error', 'exception', 'started_ns', 'time_to_first_frame_ns',
+                 'drained', 'stats')
+
+    frame_class             = None     # Tmf8828_frame or Tmf8828_frame4x4
+    captures_per_frame      = 1
+    skipped_histogram_types = ()       # histogram_type of messages that are no measurement
+
+    def __init__(self, reuse_frames=False, stats=None, recover=True, max_recoveries=None):
+        self.reuse_frames    = reuse_frames
+        self.recover         = recover
+        self.max_recoveries  = max_recoveries
+        self.stats           = stats  # CaptureStats, None measures nothing
+        self.spare           = None   # frame to assemble the next one into
+        self.returned        = None   # frame returned last
+        self.frames          = 0
+        self.frames_dropped  = 0
+        self.captures_missed = 0
+        self.out_of_order    = 0      # histogram messages with a capture_num older than the previous one
+        self.device_errors   = 0      # recovered errors, see above
+        self.stalls          = 0
+        self.resyncs         = 0
+        self.reset()
+
+    # forget the synchronization, the next frame start is locked on to again.
+    # time_to_first_frame_ns is measured from here (perf_counter_ns) to the
+    # completion of the first frame
+    def reset(self):
+        self.started_ns             = time.perf_counter_ns()
+        self.time_to_first_frame_ns = None
+        self.drained                = 0      # messages discarded by capture()
+        self.frame                  = None   # frame being assembled
+        self.received               = 0      # bit mask of the slots with a histogram message in frame
+        self.last_capture_num       = None
+        self.next_capture_num       = None   # expected capture_num of the next frame start
+        self.pending_stats          = np.zeros(2 * self.captures_per_frame, dtype=MEAS_STATS_DTYPE)
+        self.pending_stats['capture_num'] = -1   # statistics received before their histograms
+        self.non_histogram_messages = 0      # since the last histogram message
+        self.recoveries             = 0      # recovered errors since the last complete frame
+        self.recovery_limit         = self.max_recoveries   # None recovers without limit
+        self.error                  = None
+        self.exception              = None
+
+    def feed(self, msg):
+        msg_id = msg.hdr.id
+        if self.stats is not None:
+            self.stats.messages[msg_id] += 1
+            if msg_id != HISTOGRAM_ID_MEASUREMENT:
+                self.stats.non_histogram_messages += 1
+        if msg_id == HISTOGRAM_ID_MEASUREMENT:
+            self.non_histogram_messages = 0
+            return self._add_histograms(msg)
+
+        completed = None
+        if msg_id == 1:
+            if self.frame is not None and self._add_results(msg):
+                # results of the last capture, nothing more belongs to the frame
+                completed = self._complete_frame()
+        elif msg_id == 2:
+            self._add_stats(msg)
+        elif msg_id == ERROR_ID:
+            self._error(DeviceError(msg.err_msg.error_code))
+            return None
+
+        # prevent endless loops if histogram dumping is not enabled
+        self.non_histogram_messages += 1
+        if ( self.non_histogram_messages > MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES ):
+            self.non_histogram_messages = 0
+            self._error(HistogramDumpingError())
+        return completed
+
+    # the frame being assembled if all its histograms were received, else None.
+    # A complete frame is returned by feed() with the results of its last capture,
+    # call flush() at the end of a finite stream for one whose results are missing
+    def flush(self):
+        if self.frame is not None and self._frame_received():
+            return self._complete_frame()
+        return None
+
+    def _add_histograms(self, msg):
+        hist = msg.hist_msg
+        if hist.histogram_type in self.skipped_histogram_types:
+            return None
+        capture_num = hist.capture_num
+        self._histogram_seen(hist)
+
+        completed = None
+        if self.last_capture_num is not None:
+            step = ( capture_num - self.last_capture_num ) % CAPTURE_NUM_WRAP
+            if step > 1 and self.frame is not None and self._frame_received():
+                # only the results of its last capture are missing, the frame is complete
+                completed = self._complete_frame()
+            if step > CAPTURE_NUM_WRAP // 2:
+                # older than the previous capture, start over with this one:
+                # the distance to the expected frame start is meaningless
+                self.out_of_order += 1
+                self.next_capture_num = None
+                self._resync()
+            elif step > 1:
+                self.captures_missed += step - 1
+                self._resync()
+        self.last_capture_num = capture_num
+
+        if ( capture_num % self.captures_per_frame == 0 ) and ( hist.sub_capture == 0 ):
+            if self.frame is not None:
+                if self._frame_received():
+                    completed = self._complete_frame()
                 else:
-                    # print("hist.capture_num {} hist.sub_capture {} lastSubCapture {} msg.hist_msg.histogram_type {}"
-                    #     .format(hist.capture_num, hist.sub_capture, lastSubCapture, msg.hist_msg.histogram_type))
-                    
-                    lastSubCapture = hist.sub_capture
-    
-                    startOfMultiplexCapture =  hist.sub_capture == 0
-    
-                    # did we capture and log a complete sequence?
-                    if ( logging and startOfMultiplexCapture ):            # have reached the end of a complete sequence
-                        break
-    
-                    # did we find the first capture in a new sequence?
-                    if ( ( not logging ) and startOfMultiplexCapture):
-                        logging = True                                     # begin loggin the histograms
-    
-                    if logging:
-                        # print("logging it....")
-                        logString += f"#HISTINFO;Transaction ID: {hist.capture_num};Capture: {hist.capture_num % NUMBER_OF_CAPTURES_IN_8X8_MODE};Type: {hist.histogram_type};num_tdc: {hist.num_tdc};num_bins: {hist.num_bins};sub_capture: {hist.sub_capture}\n"
-    
-                        for tdc in range(0, hist.num_tdc):
-                            histogramNumber =  hist.sub_capture*HISTOGRAMS_PER_SUBCAPTURE + tdc*NUMBER_OF_TDC_CHANNELS
+                    error = self._incomplete_frame_error()
+                    if error is not None:
+                        self._error(error)
+                        return None
+                    self._drop_frame()
+            if self.next_capture_num is not None:
+                self.frames_dropped += ( ( capture_num - self.next_capture_num ) % CAPTURE_NUM_WRAP ) // self.captures_per_frame
+            self.next_capture_num = ( capture_num + self.captures_per_frame ) % CAPTURE_NUM_WRAP
 
-                            binString = ""
-                            bins = []
-    
-                            for binValue in hist.bins[tdc][:BINS_PER_TDC_CHANNEL]:
-                                binString += f";{binValue}"
-                                bins.append(binValue)
-    
-                            logString += f"#HIST{histogramNumber}{binString}\n"
-                            if (histogramNumber in returnzones):
-                                hlist.append(bins)
-    
-                            binString = ""
-                            bins = []
-    
-                            for binValue in hist.bins[tdc][BINS_PER_TDC_CHANNEL:]:
-                                binString += f";{binValue}"
-                                bins.append(binValue)
-    
-                            logString += f"#HIST{histogramNumber+1}{binString}\n"
-                            if (histogramNumber + 1 in returnzones):
-                                hlist.append(bins)
-                    else:          # not logging
-                        pass
-            else:    # preflush < n
-                pass
-
-        elif msg.hdr.id == ERROR_ID:
-            err = msg.err_msg
-            return f"#ERROR;CODE: {err.error_code}\n"
-
-        if ( messagesSinceHistogram > MAX_NUMBER_OF_NON_HISTOGRAM_MESSAGES ):
-            print("too many non-histogram messages")
-            return "#ERROR;Histogram dumping not enabled. Exiting."
-
-    if (returnzones == []):
-        return logString
+            self.frame, self.spare = self.spare, None
+            if self.frame is None:
+                self.frame = self.frame_class()
+            else:
+                self.frame.clear()
+            self.frame.capture_num = capture_num
+            self.frame.timestamp_ns = time.time_ns()
+            self.received = 0
+
+        if self.frame is not None and hist.sub_capture in (0, 1):
+            slot = ( capture_num % self.captures_per_frame ) * 2 + hist.sub_capture
+            first = slot * HISTOGRAMS_PER_SUBCAPTURE
+            rows = msg.hist_bins.reshape(-1, BINS_PER_TDC_CHANNEL)[:HISTOGRAMS_PER_SUBCAPTURE]
+            self.frame.channels[first:first + len(rows)] = rows
+            self.frame.hist_info[slot] = (capture_num, hist.histogram_type, hist.num_tdc, hist.num_bins)
+            self.received |= 1 << slot
+            if self.pending_stats['capture_num'][slot] == capture_num:
+                self.frame.stats[slot] = self.pending_stats[slot]
+        return completed
+
+    # True if the results of the last capture completed the frame
+    def _add_results(self, msg):
+        res = msg.meas_result_msg
+        # only results of the captures in this frame
+        capture = ( res.result_num - self.frame.capture_num ) % CAPTURE_NUM_WRAP
+        if capture >= self.captures_per_frame:
+            return False
+        if capture == 0:
+            self.frame.sys_ticks = res.sys_ticks
+        self._set_obj_entries(res.result_num, msg.meas_results)
+        return capture == self.captures_per_frame - 1 and self._frame_received()
+
+    def _add_stats(self, msg):
+        stats = np.frombuffer(msg.meas_stat_msg, dtype=MEAS_STATS_DTYPE)[0]
+        sub_capture = stats['sub_capture']
+        if sub_capture not in (0, 1):
+            return
+        slot = ( stats['capture_num'] % self.captures_per_frame ) * 2 + sub_capture
+        frame = self.frame
+        if frame is not None and self.received & ( 1 << slot ) and frame.hist_info[slot, 0] == stats['capture_num']:
+            frame.stats[slot] = stats
+        else:
+            self.pending_stats[slot] = stats
+
+    # histogram message hist was received, also the ones capture() skips
+    def _histogram_seen(self, hist):
+        pass
+
+    # CaptureError that ends the capture instead of dropping an incomplete frame, or None
+    def _incomplete_frame_error(self):
+        return None
+
+    def _error(self, error):
+        if self.recover and error.recoverable and ( self.recovery_limit is None or self.recoveries < self.recovery_limit ):
+            self.recoveries += 1
+            if isinstance(error, DeviceError):
+                self.device_errors += 1
+            else:
+                self.stalls += 1
+            self._resync()
+        else:
+            self.exception = error
+            self.error = str(error)
+
+    def _resync(self):
+        self.resyncs += 1
+        if self.frame is not None:
+            self._drop_frame()
+
+    def _drop_frame(self):
+        self.spare = self.frame     # never returned, can be assembled into again
+        self.frame = None
+        self.frames_dropped += 1
+
+    # returns the frame being assembled, all its histograms were received
+    def _complete_frame(self):
+        completed = self.frame
+        self._finish_frame(completed)
+        self.frame = None
+        self.spare = self.returned if self.reuse_frames else None
+        self.returned = completed
+        self.frames += 1
+        self.recoveries = 0
+        if self.time_to_first_frame_ns is None:
+            self.time_to_first_frame_ns = time.perf_counter_ns() - self.started_ns
+        if self.stats is not None:
+            self.stats.frameDone(self)
+        return completed
+
+    # capture( sub, drain=True, preflush=0 )
+    # receives from sub (see receiveMessages) until the next frame is complete
+    # and returns it. With drain the messages queued before the call are discarded
+    # first (see drainMessages), the first preflush histogram messages after that
+    # as well. The first frame start received is locked on to.
+    # Returns None on errors, see error and exception. Unless max_recoveries is
+    # set it gives up after MAX_RECOVERIES_WITHOUT_FRAME recovered errors.
+    def capture(self, sub, drain=True, preflush=0):
+        self.reset()
+        if self.recovery_limit is None:
+            self.recovery_limit = MAX_RECOVERIES_WITHOUT_FRAME
+        if drain:
+            self.drained = drainMessages(sub)
+        for msg in receiveMessages(sub, self.stats):
+            if preflush > 0 and msg.hdr.id == HISTOGRAM_ID_MEASUREMENT:
+                preflush -= 1
+                self._histogram_seen(msg.hist_msg)
+                continue
+            frame = feedTimed(self, msg)
+            if frame is not None:
+                return frame
+            if self.error:
+                return None
+        frame = self.flush()
+        if frame is not None:
+            return frame
+        self._end_of_stream(sub)
+        return None
+
+    # the messages of sub ended: EndOfStreamError, or ReadError if sub failed
+    def _end_of_stream(self, sub):
+        read_error = getattr(sub, 'error', None)
+        self.exception = ReadError(read_error) if read_error else EndOfStreamError()
+        self.error = str(self.exception)
+
+# one complete 8x8 sequence (4 captures x 2 sub-captures)
+class Tmf8828_frame:
+    __slots__ = ('capture_num', 'timestamp_ns', 'sys_ticks', 'channels', 'hist_info', 'stats', 'histograms', 'ref_histograms', 'obj')
+
+    obj_shape = (8, 8)      # rows, cols of the #OBJ line
+
+    # (8, 8, 2) distance / confidence of object 0 and 1 of every pixel, views of obj
+    @property
+    def distance_map(self):
+        return objDistanceMap(self.obj)
+
+    @property
+    def confidence_map(self):
+        return objConfidenceMap(self.obj)
+
+    def __init__(self):
+        self.capture_num    = 0       # capture_num of the first capture of the sequence
+        self.timestamp_ns   = 0       # host time.time_ns() when the sequence started
+        self.sys_ticks      = 0       # device sys_ticks of the first result message of the sequence
+        self.channels       = np.zeros((HISTOGRAMS_IN_8X8_MODE, BINS_PER_TDC_CHANNEL), dtype=np.uint32)
+        # capture_num, histogram_type, num_tdc, num_bins of the histogram message of capture c, sub-capture s at [c*2+s]
+        self.hist_info      = np.zeros((2 * NUMBER_OF_CAPTURES_IN_8X8_MODE, 4), dtype=np.int32)
+        # measurement statistics message of capture c, sub-capture s at [c*2+s] (zero if none was received)
+        self.stats          = np.zeros(2 * NUMBER_OF_CAPTURES_IN_8X8_MODE, dtype=MEAS_STATS_DTYPE)
+        self.histograms     = np.zeros((8, 8, BINS_PER_TDC_CHANNEL), dtype=np.uint32)   # pixel histograms, see channelsToFrame8x8
+        self.ref_histograms = np.zeros((len(REF_HISTOGRAM_NUMBERS), BINS_PER_TDC_CHANNEL), dtype=np.uint32)
+        self.obj            = newObjEntries()   # #OBJ entries, see objDistanceMap / objConfidenceMap
+
+    def clear(self):
+        self.sys_ticks = 0
+        self.channels.fill(0)
+        self.hist_info.fill(0)
+        self.stats.fill(0)
+        self.obj.fill(0)
+
+
+# Capture8x8Session is the frame state machine of one sensor in 8x8 mode and
+# owns all its state, sessions of different sensors are independent of each other.
+# feed() takes every received message (a Tmf8820_msg_view) and returns a
+# Tmf8828_frame each time a sequence is complete, else None.
+# It locks on to the first sequence start (capture_num % 4 == 0, sub_capture 0)
+# and then stays synchronized, every complete sequence is returned. A sequence
+# is complete with the histogram messages of all its captures and sub-captures,
+# it is returned with the results of its last capture (or the next histogram
+# message if those are missing, see flush() for the end of a stream).
+# Gaps and errors are handled as described for CaptureSession, a sequence
+# start while no sub-capture 1 was received ends the capture with a
+# TimeMultiplexingError.
+#
+# With reuse_frames the session assembles into two preallocated frames in turn:
+# nothing is allocated per sequence, but a returned frame is only valid until
+# the next one is returned.
+# res_num_offset shifts the result_num -> zone mapping (see calc_zn).
+
+class Capture8x8Session(CaptureSession):
+    __slots__ = ('res_num_offset', 'sub_capture_seen')
+
+    frame_class        = Tmf8828_frame
+    captures_per_frame = NUMBER_OF_CAPTURES_IN_8X8_MODE
+
+    def __init__(self, reuse_frames=False, res_num_offset=0, stats=None, recover=True, max_recoveries=None):
+        self.res_num_offset = res_num_offset
+        super().__init__(reuse_frames, stats, recover, max_recoveries)
+
+    def reset(self):
+        super().reset()
+        self.sub_capture_seen = False
+
+    def _histogram_seen(self, hist):
+        if hist.sub_capture == 1:
+            self.sub_capture_seen = True
+
+    def _incomplete_frame_error(self):
+        if not self.sub_capture_seen:
+            return TimeMultiplexingError()
+        return None
+
+    def _frame_received(self):
+        return self.received == FRAME_RECEIVED_8X8
+
+    def _finish_frame(self, frame):
+        channelsToFrame8x8(frame.channels, frame.histograms, frame.ref_histograms)
+
+    def _set_obj_entries(self, result_num, results):
+        setObjEntries(self.frame.obj, result_num, results, self.res_num_offset)
+
+
+# stream_8x8_frames( sub, session=None )
+# generator yielding every complete 8x8 sequence as a Tmf8828_frame, back-to-back,
+# for as long as the sensor delivers histograms. sub is a zmq socket or any
+# message source accepted by receiveMessages, e.g. a TofDeviceReader. Pass a Capture8x8Session to keep
+# access to its counters (frames_dropped, captures_missed, resyncs, ...).
+# Recoverable errors are recovered from (see CaptureSession), the stream ends
+# after printing any other error, session.exception is the CaptureError.
+
+def stream_8x8_frames( sub, session=None ):
+    if session is None:
+        session = Capture8x8Session()
+    return stream_frames(sub, session)
+
+# stream_4x4_frames( sub, session=None )
+# as stream_8x8_frames for 3x3 / 4x4 mode, yields Tmf8828_frame4x4
+
+def stream_4x4_frames( sub, session=None ):
+    if session is None:
+        session = Capture4x4Session()
+    return stream_frames(sub, session)
+
+# session.feed( msg ), timed if the session has a CaptureStats
+def feedTimed( session, msg ):
+    if session.stats is None:
+        return session.feed(msg)
+    t0 = time.perf_counter_ns()
+    frame = session.feed(msg)
+    session.stats.add('assemble', time.perf_counter_ns() - t0)
+    return frame
+
+# every complete frame of a Capture8x8Session or Capture4x4Session
+def stream_frames( sub, session ):
+    for msg in receiveMessages(sub, session.stats):
+        frame = feedTimed(session, msg)
+        if frame is not None:
+            yield frame
+        elif session.error:
+            print(session.error)
+            return
+    frame = session.flush()
+    if frame is not None:
+        yield frame
+    if getattr(sub, 'error', None):
+        session._end_of_stream(sub)
+        print(session.error)
+
+
+# asyncio versions of stream_8x8_frames / stream_4x4_frames, sub is a zmq.asyncio socket (see connectToRaspiAsync)
+
+async def stream_8x8_frames_async( sub, session=None ):
+    if session is None:
+        session = Capture8x8Session()
+    async for frame in stream_frames_async(sub, session):
+        yield frame
+
+async def stream_4x4_frames_async( sub, session=None ):
+    if session is None:
+        session = Capture4x4Session()
+    async for frame in stream_frames_async(sub, session):
+        yield frame
+
+async def stream_frames_async( sub, session ):
+    async for msg in receiveMessagesAsync(sub, session.stats):
+        frame = feedTimed(session, msg)
+        if frame is not None:
+            yield frame
+        elif session.error:
+            print(session.error)
+            return
+
+
+# stream_sensors_8x8( endpoints, sessions=None, queue_size=16, stats=None )
+# serves several sensors from one asyncio task each and merges their frames
+# into one stream of (sensor, Tmf8828_frame) tuples:
+#   endpoints  dict sensor name -> zmq uri, or a list of uris (the uri is the name)
+#   sessions   optional dict that receives the Capture8x8Session of every sensor
+#   queue_size frames buffered for the consumer, a full queue stops reading
+#              from the sensors (zmq then buffers up to its receive high water mark)
+#   stats      CaptureStats shared by all sensors, records the depth of the queue as 'sensors'
+# A sensor whose session gives up on an error is closed, the stream ends when
+# all sensors are. Any other exception of a sensor (e.g. an invalid uri) is
+# raised to the consumer and ends the stream.
+#
+#   async for sensor, frame in stream_sensors_8x8({"left": uri_l, "right": uri_r}):
+#       ...
+
+async def stream_sensors_8x8( endpoints, sessions=None, queue_size=16, stats=None ):
+    if not isinstance(endpoints, dict):
+        endpoints = {uri: uri for uri in endpoints}
+    if sessions is None:
+        sessions = dict()
+    queue = asyncio.Queue(maxsize=queue_size)
+    done = object()
+
+    # puts done or the exception of the sensor when it ends. A cancelled sensor
+    # puts nothing: the consumer is gone and does not read the queue anymore
+    async def serve(name, uri):
+        sub = None
+        end = done
+        try:
+            sub = connectToRaspiAsync(uri)
+            async for frame in stream_8x8_frames_async(sub, sessions[name]):
+                await queue.put((name, frame))
+                if stats is not None:
+                    stats.queueDepth('sensors', queue.qsize())
+        except Exception as error:
+            end = error
+        finally:
+            if sub is not None:
+                sub.close(linger=0)
+        await queue.put((name, end))
+
+    for name in endpoints:
+        sessions[name] = Capture8x8Session(stats=stats)
+    tasks = [asyncio.ensure_future(serve(name, uri)) for name, uri in endpoints.items()]
+    try:
+        running = len(tasks)
+        while running:
+            name, frame = await queue.get()
+            if frame is done:
+                running -= 1
+            elif isinstance(frame, Exception):
+                raise frame
+            else:
+                yield name, frame
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+MAX_SUB_CAPTURES_IN_4X4_MODE = 2
+HISTOGRAMS_IN_4X4_MODE       = MAX_SUB_CAPTURES_IN_4X4_MODE * HISTOGRAMS_PER_SUBCAPTURE
+ZONES_PER_SUBCAPTURE         = 9        # result channels 1 to 9 (1 to 8 in 4x4 mode)
+
+# 3x3 / 4x4 #OBJ entries: structured array (18, 2) of Tmf8820_meas_result,
+# [sub_capture * 9 + channel - 1][ch_target_idx]
+def newObjEntries4x4():
+    return np.zeros((MAX_SUB_CAPTURES_IN_4X4_MODE * ZONES_PER_SUBCAPTURE, OBJ_PER_PIXEL), dtype=MEAS_RESULT_DTYPE)
+
+def setObjEntries4x4( obj, results ):
+    ch  = results['channel']
+    sub = results['sub_capture']
+    idx = results['ch_target_idx']
+    valid = ( ch >= 1 ) & ( ch <= ZONES_PER_SUBCAPTURE ) & ( sub >= 0 ) & ( sub < MAX_SUB_CAPTURES_IN_4X4_MODE ) & ( idx >= 0 ) & ( idx < OBJ_PER_PIXEL )
+    obj[sub[valid] * ZONES_PER_SUBCAPTURE + ch[valid] - 1, idx[valid]] = results[valid]
+
+# zoneMask( returnzones )
+# boolean mask over the histogram numbers of a 3x3 / 4x4 measurement selecting
+# returnzones (any iterable of histogram numbers), compute it once and use it
+# with selectZones for every frame
+def zoneMask( returnzones ):
+    mask = np.zeros(HISTOGRAMS_IN_4X4_MODE, dtype=bool)
+    zones = np.fromiter(set(returnzones), dtype=np.intp)
+    mask[zones[( zones >= 0 ) & ( zones < HISTOGRAMS_IN_4X4_MODE )]] = True
+    return mask
+
+# the selected channel histograms of a frame (n, 128), ascending by histogram number
+def selectZones( frame, mask ):
+    received = frame.sub_captures * HISTOGRAMS_PER_SUBCAPTURE
+    return frame.channels[:received][mask[:received]]
+
+# one complete 3x3 / 4x4 measurement (1 or 2 sub-captures)
+class Tmf8828_frame4x4:
+    __slots__ = ('capture_num', 'timestamp_ns', 'sys_ticks', 'sub_captures', 'channels', 'hist_info', 'stats', 'obj')
+
+    # rows, cols of the #OBJ line
+    @property
+    def obj_shape(self):
+        return (4, 4) if self.sub_captures > 1 else (3, 3)
+
+    def __init__(self):
+        self.capture_num  = 0     # capture_num of sub-capture 0
+        self.timestamp_ns = 0     # host time.time_ns() when sub-capture 0 arrived
+        self.sys_ticks    = 0     # device sys_ticks of the result message
+        self.sub_captures = 0     # 1 in 3x3 mode, 2 in time multiplexed 4x4 mode
+        # channel histograms by histogram number (sub_capture * 10 + channel)
+        self.channels     = np.zeros((HISTOGRAMS_IN_4X4_MODE, BINS_PER_TDC_CHANNEL), dtype=np.uint32)
+        # capture_num, histogram_type, num_tdc, num_bins of the histogram message of each sub-capture
+        self.hist_info    = np.zeros((MAX_SUB_CAPTURES_IN_4X4_MODE, 4), dtype=np.int32)
+        # measurement statistics message of each sub-capture (zero if none was received)
+        self.stats        = np.zeros(MAX_SUB_CAPTURES_IN_4X4_MODE, dtype=MEAS_STATS_DTYPE)
+        self.obj          = newObjEntries4x4()
+
+    def clear(self):
+        self.sys_ticks = 0
+        self.sub_captures = 0
+        self.channels.fill(0)
+        self.hist_info.fill(0)
+        self.stats.fill(0)
+        self.obj.fill(0)
+
+
+# Capture4x4Session is the frame state machine of one sensor in 3x3 / 4x4 mode,
+# used like Capture8x8Session. A measurement starts with sub_capture 0 and
+# ends with the next one, electrical calibration histograms are skipped.
+# A measurement is only complete with all sub-captures of the mode: sub_captures
+# (2 for 4x4, 1 for 3x3), by default the most sub-captures seen since reset().
+
+class Capture4x4Session(CaptureSession):
+    __slots__ = ('sub_captures', 'sub_captures_seen')
+
+    frame_class             = Tmf8828_frame4x4
+    skipped_histogram_types = (1,)     # electrical calibration
+
+    def __init__(self, reuse_frames=False, stats=None, recover=True, sub_captures=None, max_recoveries=None):
+        self.sub_captures = sub_captures
+        super().__init__(reuse_frames, stats, recover, max_recoveries)
+
+    def reset(self):
+        super().reset()
+        self.sub_captures_seen = 0      # highest sub_capture received + 1
+
+    def _histogram_seen(self, hist):
+        if hist.sub_capture < MAX_SUB_CAPTURES_IN_4X4_MODE:
+            self.sub_captures_seen = max(self.sub_captures_seen, hist.sub_capture + 1)
+
+    # sub-captures 0 .. n-1 of the mode all received
+    def _frame_received(self):
+        return self.received == ( 1 << ( self.sub_captures or self.sub_captures_seen ) ) - 1
+
+    def _finish_frame(self, frame):
+        frame.sub_captures = self.received.bit_length()
+
+    def _set_obj_entries(self, result_num, results):
+        setObjEntries4x4(self.frame.obj, results)
+
+
+Capture4x4Result = collections.namedtuple('Capture4x4Result', ['log', 'zones', 'frame'])
+
+# captureHistograms4x4( sub, returnzones=[], session=None )
+# captures one 3x3 / 4x4 measurement and returns a Capture4x4Result: the log
+# text, the (n, 128) histograms of returnzones (None without) and the
+# Tmf8828_frame4x4. Raises the CaptureError that ended the capture.
+
+def captureHistograms4x4( sub, returnzones=[], session=None ):
+    if session is None:
+        session = Capture4x4Session()
+
+    # the messages queued so far are discarded for purposes of flushing the input buffer
+    frame = session.capture(sub)
+    if frame is None:
+        raise session.exception
+
+    t0 = time.perf_counter_ns()
+    log = HistogramLogWriter(io.StringIO(), HIST_LABELS_4X4)
+    log.writeFrame(frame)
+    logString = log.file.getvalue()
+    if session.stats is not None:
+        session.stats.add('format', time.perf_counter_ns() - t0)
+
+    zones = selectZones(frame, zoneMask(returnzones)) if returnzones else None
+    return Capture4x4Result(logString, zones, frame)
+
+# getAllHistogramsIn4x4Mode( sub, returnzones=[], session=None )
+# captures one 3x3 / 4x4 measurement, returns the log text and, if returnzones
+# (histogram numbers, any iterable) are given, the (n, 128) array of their
+# histograms in ascending histogram number order, on errors the "#ERROR;..." text
+
+def getAllHistogramsIn4x4Mode( sub, returnzones=[], session=None ):
+    try:
+        result = captureHistograms4x4(sub, returnzones, session)
+    except CaptureError as error:
+        print(error)
+        return str(error)
+
+    if not returnzones:
+        return result.log
     else:
-        return logString, hlist
+        return result.log, result.zones
+
 
+# filterNonPixel( vals )
+# the values of the 64 pixel histograms of a list of 80 per histogram values,
+# in histogram number order
 def filterNonPixel(vals):
-    used8x8 = [   False,True,True,True,True,True,True,True,True,False,False,True,True,True,True,True,
-                  True,True,True,False,False,True,True,True,True,True,True,True,True,False,False,True,
-                  True,True,True,True,True,True,True,False,False,True,True,True,True,True,True,True,
-                  True,False,False,True,True,True,True,True,True,True,True,False,False,True,True,True,
-                  True,True,True,True,True,False,False,True,True,True,True,True,True,True,True,False]
-    return [vals[x] for x in range(80) if used8x8[x]]
+    return [vals[x] for x in PIXEL_CHANNELS]
 
 def calc_crosstalk(h):
     return max(h[5:20])
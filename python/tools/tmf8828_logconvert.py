@@ -0,0 +1,179 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Conversion of 8x8 histogram text logs (#HISTINFO / #HIST / #OBJ lines as
+# written by getAllHistogramsIn8x8Mode and the EVM GUI) to binary frames and back.
+#
+# Logs are read as a stream, chunk_frames frames at a time: the lines are only
+# sorted by type in python, the numbers of a whole chunk are parsed by one
+# np.fromstring call. The frames come out as tmf8828_recording.FRAME_RECORD_DTYPE
+# records with the pixel mapping applied (histograms[row][col] is pixel row*8+col+1),
+# and are written either as a recording (.bin, see RecordingReader) or as one
+# array per field (.npz). The #OBJ line only has distance and confidence, the
+# other fields of the #OBJ entries are 0. Frames without all 8 histogram
+# messages of 5 TDCs are skipped. A .npz is written from a temporary recording
+# next to it, field by field, so neither needs the whole log in memory.
+#
+#   python tmf8828_logconvert.py log1.txt log2.txt ...        log1.bin log2.bin ...
+#   python tmf8828_logconvert.py --npz logs/*.txt             log1.npz ...
+#   python tmf8828_logconvert.py --text frames.bin            frames.txt
+
+import argparse
+import concurrent.futures
+import os
+import re
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+from tmf8828_recording import FRAME_RECORD_DTYPE, OTHER_HISTOGRAM_NUMBERS, RecordingReader, RecordingWriter, recordToFrame
+
+HIST_MESSAGES_8X8 = 2 * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE
+HIST_LINES_8X8    = tof.HISTOGRAMS_IN_8X8_MODE
+OBJ_ENTRIES       = tof.OBJ_PIXELS * tof.OBJ_PER_PIXEL
+NUMBER            = re.compile(r"-?\d+")
+
+
+class HistogramLogReader:
+    # iterating yields FRAME_RECORD_DTYPE arrays of up to chunk_frames frames
+    # of the log lines (a text file or any iterable of lines)
+    def __init__(self, lines, chunk_frames=256):
+        self.lines = lines
+        self.chunk_frames = chunk_frames
+        self.frames  = 0
+        self.skipped = 0      # incomplete frames and frames with num_tdc other than 5
+
+    def __iter__(self):
+        infos, hists, objs = [], [], []
+        frame_infos, frame_hists = [], []
+        for line in self.lines:
+            if line.startswith("#HISTINFO"):
+                frame_infos.append(line)
+            elif line.startswith("#HIST"):
+                frame_hists.append(line[line.find(";") + 1:].rstrip())
+            elif line.startswith("#OBJ"):
+                if len(frame_infos) == HIST_MESSAGES_8X8 and len(frame_hists) == HIST_LINES_8X8:
+                    infos.extend(frame_infos)
+                    hists.extend(frame_hists)
+                    # #OBJ;12345678;0;8;8;distance;confidence;...
+                    objs.append(line.split(";", 5)[5].rstrip())
+                else:
+                    self.skipped += 1
+                frame_infos, frame_hists = [], []
+                if len(objs) == self.chunk_frames:
+                    records = self._records(infos, hists, objs)
+                    if len(records):
+                        yield records
+                    infos, hists, objs = [], [], []
+        if objs:
+            records = self._records(infos, hists, objs)
+            if len(records):
+                yield records
+
+    def _records(self, infos, hists, objs):
+        n = len(objs)
+        records = np.zeros(n, dtype=FRAME_RECORD_DTYPE)
+        channels = np.fromstring(";".join(hists), dtype=np.int64, sep=";")
+        if channels.size != n * HIST_LINES_8X8 * tof.BINS_PER_TDC_CHANNEL:
+            raise ValueError("#HIST lines without 128 bins in the log")
+        channels = channels.reshape(n, HIST_LINES_8X8, tof.BINS_PER_TDC_CHANNEL)
+        # Transaction ID, Capture, Type, num_tdc, num_bins, sub_capture
+        info = np.array(NUMBER.findall("".join(infos)), dtype=np.int64).reshape(n, HIST_MESSAGES_8X8, 6)
+        obj = np.fromstring(";".join(objs), dtype=np.int64, sep=";").reshape(n, OBJ_ENTRIES, 2)
+        complete = ( info[:, :, 3] == tof.MAX_TDC ).all(axis=1)
+        if not complete.all():
+            self.skipped += n - int(complete.sum())
+            channels, info, obj = channels[complete], info[complete], obj[complete]
+            n = len(info)
+            records = records[:n]
+
+        records['capture_num']      = info[:, 0, 0]
+        records['hist_info']        = info[:, :, [0, 2, 3, 4]]
+        records['histograms']       = channels[:, tof.PIXEL_HISTOGRAM_NUMBERS].reshape(n, 8, 8, tof.BINS_PER_TDC_CHANNEL)
+        records['ref_histograms']   = channels[:, tof.REF_HISTOGRAM_NUMBERS]
+        records['other_histograms'] = channels[:, OTHER_HISTOGRAM_NUMBERS]
+        records['obj']['distance_mm'] = obj[:, :, 0]
+        records['obj']['confidence']  = obj[:, :, 1]
+        self.frames += n
+        return records
+
+
+# convertLog( path, out_path=None, chunk_frames=256 )
+# converts the log path to out_path (.npz: one array per record field, else a
+# recording), by default path with the extension .bin. Returns the numbers of
+# converted and skipped frames.
+def convertLog( path, out_path=None, chunk_frames=256 ):
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + ".bin"
+    with open(path, "r") as file:
+        reader = HistogramLogReader(file, chunk_frames)
+        recording_path = out_path + ".tmp.bin" if out_path.endswith(".npz") else out_path
+        if os.path.exists(recording_path):
+            os.remove(recording_path)
+        with RecordingWriter(recording_path) as recording:
+            for records in reader:
+                recording.writeRecords(records)
+    if recording_path != out_path:
+        try:
+            # the fields are strided views of the mapped recording, np.savez
+            # writes them in buffered pieces
+            with RecordingReader(recording_path) as recording:
+                np.savez(out_path, **{name: recording.records[name] for name in FRAME_RECORD_DTYPE.names})
+        finally:
+            os.remove(recording_path)
+    return reader.frames, reader.skipped
+
+# convertLogs( paths, extension=".bin", processes=None )
+# converts every log in paths next to it, one file per process at a time
+def convertLogs( paths, extension=".bin", processes=None ):
+    out_paths = [os.path.splitext(path)[0] + extension for path in paths]
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        return dict(zip(paths, pool.map(convertLog, paths, out_paths)))
+
+# writeLog( records, file )
+# writes FRAME_RECORD_DTYPE records as the log text getAllHistogramsIn8x8Mode writes
+def writeLog( records, file ):
+    log = tof.HistogramLogWriter(file, tof.HIST_LABELS_8X8)
+    frame = None
+    for rec in records:
+        frame = recordToFrame(rec, frame)
+        log.writeFrame(frame)
+
+def recordingToLog( path, out_path=None ):
+    if out_path is None:
+        out_path = os.path.splitext(path)[0] + ".txt"
+    with RecordingReader(path) as recording, open(out_path, "w") as file:
+        writeLog(recording.records, file)
+        return len(recording)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert TMF8828 8x8 histogram logs to binary frames and back")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--npz", action="store_true", help="write .npz arrays instead of recordings")
+    parser.add_argument("--text", action="store_true", help="convert recordings back to log text")
+    parser.add_argument("--processes", type=int, help="parallel conversions, default os.cpu_count()")
+    args = parser.parse_args()
+
+    if args.text:
+        for path in args.paths:
+            print(f"{path}: {recordingToLog(path)} frames")
+    else:
+        for path, (frames, skipped) in convertLogs(args.paths, ".npz" if args.npz else ".bin", args.processes).items():
+            print(f"{path}: {frames} frames, {skipped} incomplete frames skipped")
@@ -0,0 +1,238 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Binary recording and replay of 8x8 frames.
+#
+# File layout: a RECORDING_HEADER followed by fixed size FRAME_RECORD_DTYPE
+# records, one per frame, in capture order. Because all records have the same
+# size, frame n is at RECORDING_HEADER_SIZE + n * record size: the file is its
+# own frame index. Frames are only ever appended, a record cut short by a crash
+# is ignored on replay.
+#
+# The reader maps the file and returns numpy views into the mapping, nothing is
+# copied until the data is used.
+#
+#   python tmf8828_recording.py capture.bin 1000     records 1000 frames from the EVM
+
+import mmap
+import os
+import sys
+import time
+import numpy as np
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+
+RECORDING_MAGIC   = b"TMF8828F"
+RECORDING_VERSION = 1
+
+RECORDING_HEADER = np.dtype([
+    ('magic',       'S8'),
+    ('version',     np.uint32),
+    ('record_size', np.uint32),
+    ('reserved',    np.uint8, 48),
+])
+RECORDING_HEADER_SIZE = RECORDING_HEADER.itemsize
+
+# histogram numbers that are neither pixels nor reference channels, recorded so
+# that the 80 channel histograms of a frame can be restored
+OTHER_HISTOGRAM_NUMBERS = np.setdiff1d(np.arange(tof.HISTOGRAMS_IN_8X8_MODE),
+                                       np.concatenate((tof.PIXEL_HISTOGRAM_NUMBERS, tof.REF_HISTOGRAM_NUMBERS)))
+
+FRAME_RECORD_DTYPE = np.dtype([
+    ('capture_num',      np.uint32),
+    ('sys_ticks',        np.uint32),
+    ('timestamp_ns',     np.int64),
+    ('hist_info',        np.int32, (2 * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE, 4)),
+    ('histograms',       np.uint32, (8, 8, tof.BINS_PER_TDC_CHANNEL)),
+    ('ref_histograms',   np.uint32, (len(tof.REF_HISTOGRAM_NUMBERS), tof.BINS_PER_TDC_CHANNEL)),
+    ('other_histograms', np.uint32, (len(OTHER_HISTOGRAM_NUMBERS), tof.BINS_PER_TDC_CHANNEL)),
+    ('obj',              tof.MEAS_RESULT_DTYPE, (tof.OBJ_PIXELS * tof.OBJ_PER_PIXEL,)),
+])
+
+
+# stores a Tmf8828_frame in rec, an element of a FRAME_RECORD_DTYPE array
+def frameToRecord(frame, rec):
+    rec['capture_num']      = frame.capture_num
+    rec['sys_ticks']        = frame.sys_ticks & 0xFFFFFFFF
+    rec['timestamp_ns']     = frame.timestamp_ns
+    rec['hist_info']        = frame.hist_info
+    rec['histograms']       = frame.histograms
+    rec['ref_histograms']   = frame.ref_histograms
+    rec['other_histograms'] = frame.channels[OTHER_HISTOGRAM_NUMBERS]
+    rec['obj']              = frame.obj.reshape(-1)
+
+
+# recordToFrame( rec, frame=None )
+# Tmf8828_frame of the record rec, the histograms and obj are views of rec.
+# Every call allocates a new frame and copies the 80 channel histograms into
+# it. Replay loops pass the frame returned before, it is then filled again
+# without allocating (its previous contents are gone).
+def recordToFrame(rec, frame=None):
+    if frame is None:
+        frame = tof.Tmf8828_frame()
+    else:
+        frame.stats.fill(0)     # not recorded
+    frame.capture_num    = int(rec['capture_num'])
+    frame.sys_ticks      = int(rec['sys_ticks'])
+    frame.timestamp_ns   = int(rec['timestamp_ns'])
+    frame.hist_info[:]   = rec['hist_info']
+    frame.histograms     = rec['histograms']
+    frame.ref_histograms = rec['ref_histograms']
+    channels = frame.channels
+    channels[tof.PIXEL_HISTOGRAM_NUMBERS] = rec['histograms'].reshape(64, tof.BINS_PER_TDC_CHANNEL)
+    channels[tof.REF_HISTOGRAM_NUMBERS]   = rec['ref_histograms']
+    channels[OTHER_HISTOGRAM_NUMBERS]     = rec['other_histograms']
+    frame.obj            = rec['obj'].reshape(tof.OBJ_PIXELS, tof.OBJ_PER_PIXEL)
+    return frame
+
+
+class RecordingWriter:
+    # appends frames to path, a new file gets a header, an existing one must be
+    # a recording of the same record layout
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        self.record = np.zeros(1, dtype=FRAME_RECORD_DTYPE)
+        if self.file.tell() == 0:
+            header = np.zeros(1, dtype=RECORDING_HEADER)
+            header['magic'] = RECORDING_MAGIC
+            header['version'] = RECORDING_VERSION
+            header['record_size'] = FRAME_RECORD_DTYPE.itemsize
+            self.file.write(header.tobytes())
+        else:
+            checkHeader(np.fromfile(path, dtype=RECORDING_HEADER, count=1), path)
+            # drop a partial record left by an interrupted recording
+            frames = (self.file.tell() - RECORDING_HEADER_SIZE) // FRAME_RECORD_DTYPE.itemsize
+            self.file.truncate(RECORDING_HEADER_SIZE + frames * FRAME_RECORD_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+
+    def write(self, frame):
+        frameToRecord(frame, self.record[0])
+        self.file.write(self.record.data)
+
+    # appends an array of FRAME_RECORD_DTYPE records at once
+    def writeRecords(self, records):
+        self.file.write(np.ascontiguousarray(records, dtype=FRAME_RECORD_DTYPE).data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def checkHeader(header, path):
+    if len(header) != 1 or header['magic'][0] != RECORDING_MAGIC:
+        raise ValueError(f"{path} is not a TMF8828 frame recording")
+    if header['version'][0] != RECORDING_VERSION:
+        raise ValueError(f"{path}: unsupported recording version {header['version'][0]}")
+    if header['record_size'][0] != FRAME_RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path}: record size {header['record_size'][0]} does not match the frame layout of "
+                         f"version {RECORDING_VERSION} ({FRAME_RECORD_DTYPE.itemsize} bytes)")
+
+
+class RecordingReader:
+    # random access to a recording through a read-only memory map:
+    #   reader.records            structured array of all frames (FRAME_RECORD_DTYPE)
+    #   reader.records['histograms'][n]    (8, 8, 128) view of frame n
+    #   reader.frame(n)           frame n as a Tmf8828_frame (histograms are views, see recordToFrame)
+    #   reader.findTime(t_ns)     number of the first frame at or after host time t_ns
+    # frames recorded while the reader is open are seen after refresh()
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = None
+        self.records = np.zeros(0, dtype=FRAME_RECORD_DTYPE)
+        self.refresh()
+
+    def refresh(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if size < RECORDING_HEADER_SIZE:
+            raise ValueError(f"{self.path} is not a TMF8828 frame recording")
+        # a previous map stays valid as long as frames returned from it are in use
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        checkHeader(np.frombuffer(self.map, dtype=RECORDING_HEADER, count=1), self.path)
+        frames = (size - RECORDING_HEADER_SIZE) // FRAME_RECORD_DTYPE.itemsize
+        self.records = np.frombuffer(self.map, dtype=FRAME_RECORD_DTYPE, count=frames, offset=RECORDING_HEADER_SIZE)
+
+    def __len__(self):
+        return len(self.records)
+
+    # frame( n, frame=None ), frame is reused if given (see recordToFrame)
+    def frame(self, n, frame=None):
+        return recordToFrame(self.records[n], frame)
+
+    def __iter__(self):
+        for n in range(len(self.records)):
+            yield self.frame(n)
+
+    def findTime(self, timestamp_ns):
+        return int(np.searchsorted(self.records['timestamp_ns'], timestamp_ns))
+
+    # replay( start=0, speed=None, reuse_frame=False )
+    # yields the frames from number start on, paced by their recorded host
+    # timestamps divided by speed (2.0 is twice as fast), None replays as fast as possible.
+    # With reuse_frame one Tmf8828_frame is filled with every frame in turn:
+    # nothing is allocated per frame, but a frame is only valid until the next one
+    def replay(self, start=0, speed=None, reuse_frame=False):
+        t0 = None
+        frame = None
+        for n in range(start, len(self.records)):
+            frame = self.frame(n, frame if reuse_frame else None)
+            if speed:
+                if t0 is None:
+                    t0 = (time.monotonic_ns(), frame.timestamp_ns)
+                due = t0[0] + (frame.timestamp_ns - t0[1]) / speed
+                delay = (due - time.monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+            yield frame
+
+    def close(self):
+        self.records = None
+        self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "tmf8828_frames.bin"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    zmqSocket = tof.connectToRaspi()
+    with RecordingWriter(path) as recording:
+        for n, frame in enumerate(tof.stream_8x8_frames(zmqSocket)):
+            recording.write(frame)
+            if n + 1 >= count:
+                break
+    zmqSocket.close()
+
+    with RecordingReader(path) as recording:
+        print(f"{path}: {len(recording)} frames")
@@ -0,0 +1,253 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Fan-out of 8x8 frames to several local processes through shared memory.
+#
+# One process receives and assembles the frames and publishes them with a
+# SharedFrameWriter; any number of processes read them with a SharedFrameReader,
+# without their own zmq subscription, decoding or frame assembly.
+#
+# The shared memory holds a header, a sequence number per slot and a ring of
+# slots records of tmf8828_recording.FRAME_RECORD_DTYPE. Frames are numbered
+# from 1 (seq), frame seq goes to slot (seq - 1) % slots. Every slot is guarded
+# by a seqlock: its sequence number is odd while the writer fills it and
+# 2 * seq when frame seq is complete. A reader copies a slot and checks that
+# the sequence number is unchanged, else the frame was overwritten meanwhile.
+# Readers never block the writer: a reader that falls more than slots frames
+# behind loses frames (counted in missed).
+#
+#   python tmf8828_shared.py [--replace] [name] [slots]
+#                                                 publishes the frames of the EVM
+#
+#   with SharedFrameReader("tmf8828") as shared:
+#       for frame in shared.frames():             every frame
+#           ...
+#       frame = shared.latest()                   only the most recent one
+
+import sys
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+from tmf8828_recording import FRAME_RECORD_DTYPE, frameToRecord, recordToFrame
+
+SHARED_NAME    = "tmf8828"
+SHARED_MAGIC   = b"TMF8828S"
+SHARED_VERSION = 1
+
+SHARED_HEADER = np.dtype([
+    ('magic',       'S8'),
+    ('version',     np.uint32),
+    ('slots',       np.uint32),
+    ('record_size', np.uint32),
+    ('reserved',    np.uint32),
+    ('write_seq',   np.uint64),     # seq of the last complete frame, 0 before the first
+])
+
+# names (as the resource tracker knows them) of the segments created by the
+# SharedFrameWriters of this process, forked children inherit them with the
+# resource tracker they share
+_written = set()
+
+# the resource tracker gets POSIX shared memory names with their leading "/"
+def _trackerName(shm):
+    return shm.name if shm.name.startswith("/") else "/" + shm.name
+
+def _layout(slots):
+    # offsets of the slot sequence numbers and of the records, and the total size
+    seq_offset = SHARED_HEADER.itemsize
+    records_offset = -( -( seq_offset + 8 * slots ) // 64 ) * 64
+    return seq_offset, records_offset, records_offset + slots * FRAME_RECORD_DTYPE.itemsize
+
+
+class _SharedFrames:
+    def _map(self, slots):
+        seq_offset, records_offset, _ = _layout(slots)
+        buf = self.shm.buf
+        self.header   = np.ndarray((), dtype=SHARED_HEADER, buffer=buf)
+        self.slot_seq = np.ndarray(slots, dtype=np.uint64, buffer=buf, offset=seq_offset)
+        self.records  = np.ndarray(slots, dtype=FRAME_RECORD_DTYPE, buffer=buf, offset=records_offset)
+        self.slots    = slots
+
+    def _unmap(self):
+        self.header = self.slot_seq = self.records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedFrameWriter(_SharedFrames):
+    # creates the shared memory name for slots frames. If name exists this raises
+    # FileExistsError, another publisher may still use it; replace=True unlinks
+    # it, e.g. a stale one left by a publisher that did not exit cleanly
+    def __init__(self, name=SHARED_NAME, slots=16, replace=False):
+        size = _layout(slots)[2]
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            if not replace:
+                raise
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        _written.add(_trackerName(self.shm))
+        self._map(slots)
+        self.header['magic']       = SHARED_MAGIC
+        self.header['version']     = SHARED_VERSION
+        self.header['slots']       = slots
+        self.header['record_size'] = FRAME_RECORD_DTYPE.itemsize
+        self.seq = 0
+
+    def publish(self, frame):
+        self.seq += 1
+        slot = ( self.seq - 1 ) % self.slots
+        self.slot_seq[slot] = 2 * self.seq - 1
+        frameToRecord(frame, self.records[slot])
+        self.slot_seq[slot] = 2 * self.seq
+        self.header['write_seq'] = self.seq
+        return self.seq
+
+    def close(self):
+        if self.shm is not None:
+            self._unmap()
+            self.shm.close()
+            _written.discard(_trackerName(self.shm))
+            # takes back the registration of the creation
+            self.shm.unlink()
+            self.shm = None
+
+
+class SharedFrameReader(_SharedFrames):
+    def __init__(self, name=SHARED_NAME):
+        # the writer owns the memory, it must not be unlinked when a reader exits
+        try:
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # python < 3.13 registers attached memory as well. In the process of
+            # the writer the tracker already had it, the registration stays the
+            # writer's, unlink() takes it back
+            self.shm = shared_memory.SharedMemory(name)
+            if _trackerName(self.shm) not in _written:
+                resource_tracker.unregister(_trackerName(self.shm), "shared_memory")
+        header = np.ndarray((), dtype=SHARED_HEADER, buffer=self.shm.buf)
+        if header['magic'] != SHARED_MAGIC or header['version'] != SHARED_VERSION or header['record_size'] != FRAME_RECORD_DTYPE.itemsize:
+            self.shm.close()
+            raise ValueError(f"{name} is not a TMF8828 shared frame ring")
+        self._map(int(header['slots']))
+        self.next_seq = 1        # next frame for frames()
+        self.missed   = 0        # frames overwritten before frames() got to them
+
+    # seq of the last published frame, 0 if there is none yet
+    @property
+    def last_seq(self):
+        return int(self.header['write_seq'])
+
+    # view( seq )
+    # zero-copy FRAME_RECORD_DTYPE record of frame seq, None if it is not in the
+    # ring (anymore). Check valid(seq) after using the data: the writer may have
+    # overwritten it meanwhile.
+    def view(self, seq):
+        slot = ( seq - 1 ) % self.slots
+        if seq < 1 or self.slot_seq[slot] != 2 * seq:
+            return None
+        return self.records[slot]
+
+    def valid(self, seq):
+        return seq >= 1 and self.slot_seq[( seq - 1 ) % self.slots] == 2 * seq
+
+    # read( seq, out=None )
+    # copy of the record of frame seq (into the record out if given), None if
+    # it is not in the ring (anymore)
+    def read(self, seq, out=None):
+        slot = ( seq - 1 ) % self.slots
+        if out is None:
+            out = np.zeros((), dtype=FRAME_RECORD_DTYPE)
+        while True:
+            before = self.slot_seq[slot]
+            if seq < 1 or before != 2 * seq:
+                return None
+            out[...] = self.records[slot]
+            if self.slot_seq[slot] == before:
+                return out
+
+    # the most recent frame as a Tmf8828_frame, None if there is none yet
+    def latest(self):
+        while self.last_seq:
+            rec = self.read(self.last_seq)
+            if rec is not None:
+                return recordToFrame(rec)
+        return None
+
+    # frames( poll_s=0.001, timeout_s=None )
+    # yields every frame from next_seq on (from the oldest frame in the ring if
+    # that was overwritten) as Tmf8828_frame, waiting for new frames until none
+    # arrived for timeout_s (None waits forever)
+    def frames(self, poll_s=0.001, timeout_s=None):
+        waited = 0.0
+        while True:
+            if self.next_seq > self.last_seq:
+                if timeout_s is not None and waited >= timeout_s:
+                    return
+                time.sleep(poll_s)
+                waited += poll_s
+                continue
+            waited = 0.0
+            oldest = max(1, self.last_seq - self.slots + 1)
+            if self.next_seq < oldest:
+                self.missed += oldest - self.next_seq
+                self.next_seq = oldest
+            rec = self.read(self.next_seq)
+            if rec is None:      # overwritten while reading, catch up
+                continue
+            self.next_seq += 1
+            yield recordToFrame(rec)
+
+    def close(self):
+        if self.shm is not None:
+            self._unmap()
+            self.shm.close()
+            self.shm = None
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != "--replace"]
+    replace = len(args) < len(sys.argv) - 1
+    name = args[0] if len(args) > 0 else SHARED_NAME
+    slots = int(args[1]) if len(args) > 1 else 16
+
+    try:
+        shared = SharedFrameWriter(name, slots, replace=replace)
+    except FileExistsError:
+        print(f"#ERROR;shared memory {name} exists, use --replace if no publisher is running")
+        sys.exit(1)
+    zmqSocket = tof.connectToRaspi()
+    with shared:
+        print(f"publishing frames to shared memory {name}")
+        try:
+            for frame in tof.stream_8x8_frames(zmqSocket):
+                shared.publish(frame)
+        except KeyboardInterrupt:
+            pass
+    zmqSocket.close()
@@ -0,0 +1,286 @@
+# *****************************************************************************
+# * Copyright by ams AG                                                       *
+# * All rights are reserved.                                                  *
+# *                                                                           *
+# * IMPORTANT - PLEASE READ CAREFULLY BEFORE COPYING, INSTALLING OR USING     *
+# * THE SOFTWARE.                                                             *
+# *                                                                           *
+# * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS       *
+# * "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT         *
+# * LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS         *
+# * FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT  *
+# * OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,     *
+# * SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT          *
+# * LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES LOSS OF USE,      *
+# * DATA, OR PROFITS OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY      *
+# * THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT       *
+# * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE     *
+# * OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.      *
+# *****************************************************************************
+
+# Synthetic TMF8828 message streams, for running the capture tools without an EVM.
+#
+# The messages are the bytes the EVM zmq server publishes, in device order:
+# per capture the histogram and statistics message of every sub-capture,
+# followed by the result message of the capture. capture_num / result_num
+# count up and wrap at 256 like on the device.
+#
+# Histograms have ambient light, the laser pulse / crosstalk peak and one
+# target peak per channel (except the reference channels), with poisson noise.
+# The results report the targets of the zones.
+#
+#   for msg in messages8x8(frames=10): ...           bytes of every message
+#   sub = SyntheticSocket(messages8x8())             stands in for the zmq socket
+#   with SyntheticPublisher() as pub:                publishes on a zmq PUB socket
+#       sub = tof.connectToRaspi(pub.uri)
+#
+#   python tmf8828_synthetic.py [uri] [frames/s]     publishes 8x8 frames until interrupted
+
+import ctypes
+import itertools
+import math
+import sys
+import threading
+import time
+import numpy as np
+import zmq
+
+import tmf8828_get_all_histograms_in_8x8_mode_zmq as tof
+
+SYNTHETIC_URI     = "tcp://127.0.0.1:8083"
+MEAS_RESULT_ID    = 1
+MEAS_STATS_ID     = 2
+BINS_PER_MM       = 1 / 37.5      # approximate bin width of the 8x8 histograms
+AMBIENT_COUNTS    = 300
+CROSSTALK_BIN     = 14
+CROSSTALK_COUNTS  = 2000
+TARGET_COUNTS     = 1500
+
+
+def histogramMessage( capture_num, sub_capture, bins, histogram_type=0 ):
+    # bins: (num_tdc, 256) counts, tdc channel 0 in bins 0..127, channel 1 in 128..255
+    hist = tof.Tmf8820_msg_histogram()
+    hist.hdr.id         = tof.HISTOGRAM_ID_MEASUREMENT
+    hist.hdr.len        = ctypes.sizeof(hist)
+    hist.capture_num    = capture_num % tof.CAPTURE_NUM_WRAP
+    hist.sub_capture    = sub_capture
+    hist.histogram_type = histogram_type
+    hist.num_tdc        = len(bins)
+    hist.num_bins       = tof.MAX_BINS
+    np.ctypeslib.as_array(hist.bins)[:len(bins)] = bins
+    return bytes(hist)
+
+def statsMessage( capture_num, sub_capture, hits=None ):
+    stats = tof.Tmf8820_msg_meas_stats()
+    stats.hdr.id                = MEAS_STATS_ID
+    stats.hdr.len               = ctypes.sizeof(stats)
+    stats.capture_num           = capture_num % tof.CAPTURE_NUM_WRAP
+    stats.sub_capture           = sub_capture
+    stats.iterations_configured = 4000
+    if hits is not None:
+        np.ctypeslib.as_array(stats.raw_hits)[:len(hits)] = hits
+        stats.accumulated_hits = int(np.sum(hits))
+    return bytes(stats)
+
+def resultsMessage( result_num, results, sys_ticks=0 ):
+    # results: (confidence, distance_mm, channel, ch_target_idx, sub_capture) tuples
+    res = tof.Tmf8820_msg_meas_results()
+    res.hdr.id        = MEAS_RESULT_ID
+    res.hdr.len       = ctypes.sizeof(res)
+    res.result_num    = result_num % tof.CAPTURE_NUM_WRAP
+    res.sys_ticks     = sys_ticks
+    res.valid_results = len(results)
+    res.num_results   = len(results)
+    for n, result in enumerate(results[:tof.MAX_NUM_RESULTS]):
+        res.results[n] = tof.Tmf8820_meas_result(*result)
+    return bytes(res)
+
+# offset of the capture_num / result_num field of the messages that have one
+COUNTER_OFFSETS = {
+    tof.HISTOGRAM_ID_MEASUREMENT: tof.Tmf8820_msg_histogram.capture_num.offset,
+    MEAS_RESULT_ID:               tof.Tmf8820_msg_meas_results.result_num.offset,
+    MEAS_STATS_ID:                tof.Tmf8820_msg_meas_stats.capture_num.offset,
+}
+
+# renumberMessages( messages, offset )
+# the messages with offset added to their capture_num / result_num
+def renumberMessages( messages, offset ):
+    if offset % tof.CAPTURE_NUM_WRAP == 0:
+        return list(messages)
+    renumbered = []
+    for msg in messages:
+        counter = COUNTER_OFFSETS.get(tof.Tmf8820_msg_header.from_buffer_copy(msg).id)
+        if counter is not None:
+            msg = bytearray(msg)
+            value = ctypes.c_int.from_buffer(msg, counter)
+            value.value = ( value.value + offset ) % tof.CAPTURE_NUM_WRAP
+            msg = bytes(msg)
+        renumbered.append(msg)
+    return renumbered
+
+# number of captures from the first to the last measurement histogram message
+def captureSpan( messages ):
+    captures = [tof.Tmf8820_msg_histogram.from_buffer_copy(msg).capture_num for msg in messages
+                if tof.Tmf8820_msg_header.from_buffer_copy(msg).id == tof.HISTOGRAM_ID_MEASUREMENT
+                and tof.Tmf8820_msg_histogram.from_buffer_copy(msg).histogram_type == 0]
+    if not captures:
+        return 0
+    return ( captures[-1] - captures[0] ) % tof.CAPTURE_NUM_WRAP + 1
+
+def errorMessage( error_code ):
+    err = tof.Tmf8820_msg_error()
+    err.hdr.id     = tof.ERROR_ID
+    err.hdr.len    = ctypes.sizeof(err)
+    err.error_code = error_code
+    return bytes(err)
+
+
+class SyntheticScene:
+    # a static scene: distance_mm[zone] of the target seen by every histogram
+    # number and result zone, with a random but reproducible layout
+    def __init__(self, seed=0, min_mm=300, max_mm=3000):
+        self.rng = np.random.default_rng(seed)
+        self.distance_mm = self.rng.uniform(min_mm, max_mm, tof.HISTOGRAMS_IN_8X8_MODE)
+        self.hist_bins = np.arange(tof.BINS_PER_TDC_CHANNEL)
+
+    # (num_tdc, 256) bins of the histogram message of one sub-capture,
+    # first is the histogram number of its tdc 0 channel 0
+    def histogramBins(self, first, num_tdc=tof.MAX_TDC):
+        channels = num_tdc * tof.NUMBER_OF_TDC_CHANNELS
+        peak = self.distance_mm[first:first + channels, None] * BINS_PER_MM + CROSSTALK_BIN
+        target = TARGET_COUNTS * np.exp(-0.5 * ( ( self.hist_bins - peak ) / 1.5 ) ** 2)
+        target[0] = 0                  # channel 0 is the reference channel, it only sees the laser pulse
+        pulse = CROSSTALK_COUNTS * np.exp(-0.5 * ( self.hist_bins - CROSSTALK_BIN ) ** 2)
+        counts = self.rng.poisson(AMBIENT_COUNTS + pulse + target).astype(np.int32)
+        return counts.reshape(num_tdc, tof.MAX_BINS)
+
+    # results of one capture, channels 1..8 of both sub-captures: first is the
+    # histogram number of the capture, zone_of returns the histogram number
+    # that the result (sub_capture, ch) belongs to
+    def results(self, first, zone_of=None):
+        results = []
+        for sub_capture in (0, 1):
+            for ch in range(1, 9):
+                if zone_of is None:
+                    histogram = first + sub_capture * tof.HISTOGRAMS_PER_SUBCAPTURE + ch
+                else:
+                    histogram = zone_of(sub_capture, ch)
+                results.append((200 + ch, int(self.distance_mm[histogram]), ch, 0, sub_capture))
+        return results
+
+
+# histogram number of every 8x8 zone (pixel)
+HISTOGRAM_OF_ZONE = {zone: histogram for histogram, zone in tof.pixelMap.items()}
+
+
+# messages8x8( frames=None, start=0, scene=None )
+# bytes of every message of frames complete 8x8 sequences (None: endless), the
+# first capture is capture_num start (rounded down to a sequence start)
+def messages8x8( frames=None, start=0, scene=None ):
+    scene = scene or SyntheticScene()
+    start -= start % tof.NUMBER_OF_CAPTURES_IN_8X8_MODE
+    captures = itertools.count(start) if frames is None else range(start, start + frames * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE)
+    for capture_num in captures:
+        seq_step = capture_num % tof.NUMBER_OF_CAPTURES_IN_8X8_MODE
+        zone_of = lambda sub_capture, ch: HISTOGRAM_OF_ZONE[tof.calc_zn(seq_step, sub_capture, ch)]
+        yield from captureMessages(scene, capture_num, seq_step * tof.HISTOGRAMS_PER_CAPTURE_IN_8X8, zone_of=zone_of)
+
+# messages4x4( frames=None, start=0, scene=None, sub_captures=2, calibration=True )
+# same for time multiplexed 4x4 mode (sub_captures=2) or 3x3 mode (sub_captures=1),
+# with calibration the stream starts with the electrical calibration histograms
+def messages4x4( frames=None, start=0, scene=None, sub_captures=2, calibration=True ):
+    scene = scene or SyntheticScene()
+    if calibration:
+        for sub_capture in range(sub_captures):
+            yield histogramMessage(start, sub_capture, np.full((tof.MAX_TDC, tof.MAX_BINS), 100, dtype=np.int32), histogram_type=1)
+    captures = itertools.count(start) if frames is None else range(start, start + frames)
+    for capture_num in captures:
+        yield from captureMessages(scene, capture_num, 0, sub_captures)
+
+def captureMessages( scene, capture_num, first, sub_captures=2, zone_of=None ):
+    for sub_capture in range(sub_captures):
+        bins = scene.histogramBins(first + sub_capture * tof.HISTOGRAMS_PER_SUBCAPTURE)
+        yield histogramMessage(capture_num, sub_capture, bins)
+        yield statsMessage(capture_num, sub_capture, bins.sum(axis=1))
+    yield resultsMessage(capture_num, scene.results(first, zone_of), sys_ticks=capture_num * 4700)
+
+
+# SyntheticSocket( messages )
+# has the recv() of a zmq SUB socket and returns the given messages over and
+# over, like a sensor that never stops. Every repetition continues the
+# capture_num / result_num of the previous one (see renumberMessages), the
+# stream has no gaps as long as the messages do not. It never has anything
+# queued: recv(zmq.NOBLOCK) raises zmq.Again, so drainMessages returns at once.
+class SyntheticSocket:
+    def __init__(self, messages):
+        messages = list(messages)
+        # the repetitions until the counters are back at their first values
+        captures = captureSpan(messages)
+        repetitions = tof.CAPTURE_NUM_WRAP // math.gcd(captures, tof.CAPTURE_NUM_WRAP) if captures else 1
+        self.messages = itertools.cycle([zmq.Frame(m) for n in range(repetitions)
+                                         for m in renumberMessages(messages, n * captures)])
+
+    def recv(self, flags=0, copy=True):
+        if flags & zmq.NOBLOCK:
+            raise zmq.Again()
+        frame = next(self.messages)
+        return frame if not copy else frame.bytes
+
+    def close(self, linger=None):
+        pass
+
+
+# SyntheticPublisher( uri="tcp://127.0.0.1:*", messages=None, frames_per_s=None )
+# publishes messages (default: endless 8x8 sequences) from a thread on a zmq PUB
+# socket, paced to frames_per_s 8x8 sequences (None: as fast as possible).
+# uri is the address to connect to, with the port chosen if it was "*".
+class SyntheticPublisher:
+    def __init__(self, uri="tcp://127.0.0.1:*", messages=None, frames_per_s=None, ctx=None):
+        self.ctx = ctx or zmq.Context.instance()
+        self.pub = self.ctx.socket(zmq.PUB)
+        self.pub.bind(uri)
+        self.uri = self.pub.getsockopt_string(zmq.LAST_ENDPOINT)
+        self.messages = messages if messages is not None else messages8x8()
+        self.frames_per_s = frames_per_s
+        self.sent = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # pacing: one 8x8 sequence is 4 captures of 5 messages
+        interval = None if not self.frames_per_s else 1 / ( self.frames_per_s * tof.NUMBER_OF_CAPTURES_IN_8X8_MODE * 5 )
+        due = time.monotonic()
+        for msg in self.messages:
+            if self.stopped.is_set():
+                break
+            if interval:
+                due += interval
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.pub.send(msg, copy=False)
+            self.sent += 1
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.pub.close(linger=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    uri = sys.argv[1] if len(sys.argv) > 1 else SYNTHETIC_URI
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 15.0
+    with SyntheticPublisher(uri.replace("127.0.0.1", "*"), frames_per_s=rate) as pub:
+        print(f"publishing 8x8 frames at {rate} frames/s on {pub.uri}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass